@@ -1,62 +1,74 @@
 import argparse
 import logging
-import shutil
 from pathlib import Path
-from hashlib import sha256
-import imagehash 
 from thefuzz import fuzz
-
-from PIL import Image
+from dedupe_utils import HashCache, apply_plan, find_duplicates, hash_files, write_plan
 
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", help="Path to the input folder")
+    parser.add_argument("--exact", action="store_true", required=False, default=False, help="Check using exact match")
+    parser.add_argument("--distance", type=int, required=False, default=0, help="Maximum Hamming distance for perceptual hashes to count as duplicates")
+    parser.add_argument("--cluster", action="store_true", required=False, default=False, help="Group near-duplicates within --distance with vectorised clustering, keeping the largest file per group")
+    parser.add_argument("--jobs", type=int, required=False, default=1, help="Number of worker processes used for hashing")
+    parser.add_argument("--no-cache", action="store_true", required=False, default=False, help="Do not read or update the on-disk hash cache")
+    parser.add_argument("--plan", required=False, default=None, help="Path of the JSON plan of duplicate moves/deletes (default: <input>_dedupe_plan.json)")
+    parser.add_argument("--dry-run", action="store_true", required=False, default=False, help="Only write the plan, do not touch any file")
+    parser.add_argument("--resume", action="store_true", required=False, default=False, help="Skip hashing and apply an existing plan, continuing from its journal")
+    parser.add_argument("--delete", action="store_true", required=False, default=False, help="Delete duplicates instead of moving them to a temporary directory")
+    args = parser.parse_args()
+
+    IMG_PATH = Path(args.input)
+    MOVED_PATH = IMG_PATH.parent / f"{IMG_PATH.name}_dupes"
+    PLAN_PATH = Path(args.plan) if args.plan else IMG_PATH.parent / f"{IMG_PATH.name}_dedupe_plan.json"
+
+    # ====
+    if not IMG_PATH.exists():
+        logging.error(f"The path specified does not exist: {IMG_PATH}")
+    if IMG_PATH.is_file():
+        logging.error(f"The path specified is a file path, not a directory: {IMG_PATH}")
+    # ====
+
+    if args.resume:
+        logging.info(f"Applied {apply_plan(PLAN_PATH)} planned operations from {PLAN_PATH}")
+        exit()
+
+    if args.exact:
+        hash_types = ["sha256"]
+    else:
+        hash_types = ["phash", "average_hash", "colorhash", "dhash"]
+        # hash_types = ["phash", "average_hash", "dhash"]
+
+    # Decode every image once and keep all of its hashes, then run one duplicate pass per hash type
+    img_paths = [p for p in sorted(IMG_PATH.iterdir(), key=lambda x: x.stat().st_size, reverse=True) if p.suffix in (".png", ".jpg", ".jpeg", ".webp")]
+    cache = None if args.no_cache else HashCache(IMG_PATH.parent / f"{IMG_PATH.name}_hashes.sqlite")
+    image_hashes = hash_files(img_paths, hash_types, args.jobs, cache=cache)
+    if cache is not None:
+        cache.close()
+    removed = set()
+    actions = []
+
+    for hash_type in hash_types:
+        print("Hash type: {0}".format(hash_type))
+        remaining = [path for path in img_paths if path not in removed]
+        hashes = [image_hashes[path][hash_type] for path in remaining]
+        for img_path, prev_file in find_duplicates(remaining, hashes, args.distance, args.cluster):
+            removed.add(img_path)
+            dst = None if args.delete else str(MOVED_PATH / img_path.name)
+            actions.append({"match": str(prev_file), "files": [[str(img_path), dst]]})
+            logging.info(f"Duplicate image {img_path.name}. Matching file: {prev_file.name}")
+            if (ratio := fuzz.ratio(img_path.stem, prev_file.stem)) < 80:
+                logging.error(f"^^^^^^^^^ {ratio} ^^^^^^^^^")
+
+    # Apply all moves/deletes in one pass once every duplicate is known
+    write_plan(PLAN_PATH, actions)
+    logging.info(f"Wrote plan with {len(actions)} duplicates to {PLAN_PATH}")
+    if not args.dry_run:
+        logging.info(f"{'Deleted' if args.delete else 'Moved'} {apply_plan(PLAN_PATH)} duplicate images")
 
-parser = argparse.ArgumentParser()
-parser.add_argument("input", help="Path to the input folder")
-parser.add_argument("--exact", action="store_true", required=False, default=False, help="Check using exact match")
-parser.add_argument("--delete", action="store_true", required=False, default=False, help="Delete duplicates instead of moving them to a temporary directory")
-args = parser.parse_args()
-
-IMG_PATH = Path(args.input)
-MOVED_PATH = IMG_PATH.parent / f"{IMG_PATH.name}_dupes"
-if not args.delete:
-    MOVED_PATH.mkdir(parents=True, exist_ok=True)
-
-# ====
-if not IMG_PATH.exists():
-    logging.error(f"The path specified does not exist: {IMG_PATH}")
-if IMG_PATH.is_file():
-    logging.error(f"The path specified is a file path, not a directory: {IMG_PATH}")
-# ====
-
-hashed_files = {}
-if args.exact:
-    hash_types = [lambda x: sha256(x.tobytes()).digest()]
-else:
-    hash_types = [imagehash.phash, imagehash.average_hash, imagehash.colorhash, imagehash.dhash]
-    # hash_types = [imagehash.phash, imagehash.average_hash, imagehash.dhash]
-
-for hash_type in hash_types:
-    print("Hash type: {0}".format(hash_type))
-    for img_path in sorted(IMG_PATH.iterdir(), key=lambda x: x.stat().st_size, reverse=True):
-        if img_path.suffix not in (".png", ".jpg", ".jpeg", ".webp"):
-            continue
-        with Image.open(img_path) as hr_img:
-            image_hash = hash_type(hr_img)
-        for prev_file, prev_hash in hashed_files.items():
-            if prev_hash == image_hash:
-                if args.delete:
-                    img_path.unlink()
-                else:
-                    shutil.move(img_path, MOVED_PATH / img_path.name)
-                logging.info(f"Duplicate image {img_path.name}. Matching file: {prev_file.name}")
-                if (ratio := fuzz.ratio(img_path.stem, prev_file.stem)) < 80:
-                    logging.error(f"^^^^^^^^^ {ratio} ^^^^^^^^^")
-                break
-        else:
-            hashed_files[img_path] = image_hash
-
-logging.info("Done!")
+    logging.info("Done!")
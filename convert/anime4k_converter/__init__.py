@@ -1,6 +1,7 @@
 """Anime4K CNN converter package."""
 
 from .cli import convert, main
+from .interpolate import interpolate_models, sweep_ratios
 from .ir import Anime4KCNN, PIXEL_SHUFFLE_PERM
 
-__all__ = ["Anime4KCNN", "PIXEL_SHUFFLE_PERM", "convert", "main"]
+__all__ = ["Anime4KCNN", "PIXEL_SHUFFLE_PERM", "convert", "interpolate_models", "main", "sweep_ratios"]
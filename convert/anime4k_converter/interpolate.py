@@ -0,0 +1,70 @@
+"""Weight-space interpolation between Anime4K CNN models."""
+
+from dataclasses import replace
+
+import numpy as np
+
+from .ir import Anime4KCNN
+
+
+ARCH_FIELDS = ("num_feat", "block_depth", "factor", "n_stack", "tail_kernel")
+
+
+def model_arrays(ir: Anime4KCNN) -> list:
+    """All weight and bias arrays of a model, in a fixed order."""
+    return [ir.head_weight, ir.head_bias, *ir.mid_weights, *ir.mid_biases, ir.tail_weight, ir.tail_bias]
+
+
+def check_compatible(a: Anime4KCNN, b: Anime4KCNN) -> None:
+    """Raise ValueError unless both models have the same architecture."""
+    for field in ARCH_FIELDS:
+        if getattr(a, field) != getattr(b, field):
+            raise ValueError(f"Cannot interpolate models with different {field}: "
+                             f"{getattr(a, field)} vs {getattr(b, field)}")
+    for x, y in zip(model_arrays(a), model_arrays(b)):
+        if x.shape != y.shape:
+            raise ValueError(f"Cannot interpolate weights of shape {x.shape} and {y.shape}")
+
+
+def _from_flat(template: Anime4KCNN, flat: np.ndarray) -> Anime4KCNN:
+    arrays = []
+    offset = 0
+    for array in model_arrays(template):
+        arrays.append(flat[offset:offset + array.size].reshape(array.shape))
+        offset += array.size
+    n_mid = len(template.mid_weights)
+    return replace(
+        template,
+        head_weight=arrays[0],
+        head_bias=arrays[1],
+        mid_weights=arrays[2:2 + n_mid],
+        mid_biases=arrays[2 + n_mid:2 + 2 * n_mid],
+        tail_weight=arrays[-2],
+        tail_bias=arrays[-1],
+    )
+
+
+def interpolate_models(a: Anime4KCNN, b: Anime4KCNN, ratios) -> list:
+    """Blend two models as (a + b * ratio) / (1 + ratio), once per ratio.
+
+    A ratio of 0 gives `a`, 1 the average, a negative ratio extrapolates
+    away from `b`. Every weight of both models is packed into one vector and
+    all ratios are computed in a single broadcast, in float64 before the
+    float32 cast the writers expect.
+    """
+    check_compatible(a, b)
+    ratios = np.atleast_1d(np.asarray(ratios, dtype=np.float64))
+    if np.any(ratios == -1):
+        raise ValueError("ratio -1 divides by zero")
+    flat_a = np.concatenate([x.ravel() for x in model_arrays(a)]).astype(np.float64)
+    flat_b = np.concatenate([x.ravel() for x in model_arrays(b)]).astype(np.float64)
+    blended = (flat_a + flat_b * ratios[:, None]) / (1 + ratios[:, None])
+    return [_from_flat(a, row.astype(np.float32)) for row in blended]
+
+
+def sweep_ratios(start: float, stop: float, count: int) -> np.ndarray:
+    """Evenly spaced ratios for a sweep of `count` models, both ends included."""
+    return np.linspace(start, stop, count)
+
+
+__all__ = ["check_compatible", "interpolate_models", "model_arrays", "sweep_ratios"]
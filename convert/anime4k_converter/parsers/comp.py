@@ -2,10 +2,46 @@
 
 import re
 
-import numpy as np
-
 from ..ir import Anime4KCNN
-from ..utils import _parse_float_list, mat4_to_weights
+from .tokens import BlockLiterals, Tokenizer
+
+
+COMP_TOKENS = Tokenizer(
+    "i{}vr",
+    pass_start=r"if \(PASS == (?P<pass_idx>\d+)\)\s*\{",
+    open=r"\{",
+    close=r"\}",
+    result=r"vec4 result\d+",
+    # resultN [+]= mat4(values) * sampleTex(idx, icoord, ivec2(ox, oy))
+    mat=r"result(?P<mat_out>\d+)\s*[+]?=\s*mat4\((?P<mat_vals>[^)]+)\)(?P<mat_tail>.*)",
+    # resultN += vec4(bias)
+    bias=r"result(?P<bias_out>\d+)\s*\+=\s*vec4\((?P<bias_vals>[^)]+)\)",
+)
+
+SAMPLER = re.compile(r"sampleTex(?:Current)?\((\d+)")
+OFFSET = re.compile(r"ivec2\((-?\d+),\s*(-?\d+)\)")
+
+
+def _parse_comp_passes(text: str) -> dict:
+    """Collect the tokens of every `if (PASS == N) { ... }` block in one scan."""
+    pass_blocks = {}
+    body = None
+    depth = 0
+    for kind, m in COMP_TOKENS.tokens(text):
+        if kind == "pass_start" and body is None:
+            body = pass_blocks[int(m["pass_idx"])] = []
+            depth = 1
+        elif body is None:
+            continue
+        elif kind in ("pass_start", "open"):
+            depth += 1
+        elif kind == "close":
+            depth -= 1
+            if depth == 0:
+                body = None
+        else:
+            body.append((kind, m))
+    return pass_blocks
 
 
 def parse_comp(path: str) -> Anime4KCNN:
@@ -13,33 +49,15 @@ def parse_comp(path: str) -> Anime4KCNN:
     with open(path) as f:
         text = f.read()
 
-    lines = text.splitlines()
-
     # Extract PASS blocks
-    pass_blocks = {}
-    i = 0
-    while i < len(lines):
-        m = re.match(r"\s*if \(PASS == (\d+)\)\s*\{", lines[i])
-        if m:
-            pass_idx = int(m.group(1))
-            block_lines = []
-            depth = 1
-            i += 1
-            while i < len(lines) and depth > 0:
-                depth += lines[i].count("{") - lines[i].count("}")
-                if depth > 0:
-                    block_lines.append(lines[i])
-                i += 1
-            pass_blocks[pass_idx] = block_lines
-        else:
-            i += 1
+    pass_blocks = _parse_comp_passes(text)
 
     total_passes = max(pass_blocks.keys()) + 1
     dts_pass = total_passes - 1
     agg_pass = dts_pass - 1
 
     # Infer num_feat from result variables in pass 0
-    n_result = sum(1 for line in pass_blocks[0] if re.search(r"vec4 result\d+", line))
+    n_result = sum(1 for kind, _ in pass_blocks[0] if kind == "result")
     num_feat = n_result * 4
 
     # Count hidden passes
@@ -47,86 +65,62 @@ def parse_comp(path: str) -> Anime4KCNN:
     block_depth = hidden_count + 1
 
     # Detect CReLU
-    has_neg = any("max(-sample" in line for line in pass_blocks.get(1, []))
+    has_neg = any(kind == "mat" and "max(-sample" in m["mat_tail"] for kind, m in pass_blocks.get(1, []))
     factor = 2 if has_neg else 1
 
     # Tail kernel
-    agg_uses_offset = any(
-        "sampleTex(" in line and "sampleTexCurrent" not in line
-        for line in pass_blocks.get(agg_pass, [])
-    )
+    agg_tails = [m["mat_tail"] for kind, m in pass_blocks.get(agg_pass, []) if kind == "mat"]
+    agg_uses_offset = any("sampleTex(" in tail and "sampleTexCurrent" not in tail for tail in agg_tails)
     tail_kernel = 3 if agg_uses_offset else 1
 
     # n_stack from aggregation sampler count
-    agg_samplers = set()
-    for line in pass_blocks.get(agg_pass, []):
-        for m2 in re.finditer(r"sampleTex(?:Current)?\((\d+)", line):
-            agg_samplers.add(int(m2.group(1)))
+    agg_samplers = {int(idx) for tail in agg_tails for idx in SAMPLER.findall(tail)}
     n_tpg = num_feat // 4
     n_stack = len(agg_samplers) // n_tpg if agg_samplers else 5
 
-    # Allocate tensors
-    head_w = np.zeros((num_feat, 3, 3, 3), dtype=np.float32)
-    head_b = np.zeros(num_feat, dtype=np.float32)
-    mid_ws = [np.zeros((num_feat, num_feat * factor, 3, 3), dtype=np.float32)
-              for _ in range(block_depth - 1)]
-    mid_bs = [np.zeros(num_feat, dtype=np.float32) for _ in range(block_depth - 1)]
-    tail_in = num_feat * factor * n_stack
-    tail_w = np.zeros((12, tail_in, tail_kernel, tail_kernel), dtype=np.float32)
-    tail_b = np.zeros(12, dtype=np.float32)
-
-    def parse_and_fill(block_lines, weight, bias, pass_type):
-        """Parse mat4/vec4 lines and fill weight/bias tensors."""
-        for line in block_lines:
-            s = line.strip()
-
-            # mat4 line
-            mat_m = re.search(r"result(\d+)\s*[+]?=\s*mat4\(([^)]+)\)", s)
-            if mat_m:
-                result_idx = int(mat_m.group(1))
-                vals = _parse_float_list(mat_m.group(2))
-                out_start = result_idx * 4
-
-                is_neg = "max(-sample" in s
-                samp_m = re.search(r"sampleTex(?:Current)?\((\d+)", s)
-                sampler_idx = int(samp_m.group(1)) if samp_m else 0
-                off_m = re.search(r"ivec2\((-?\d+),\s*(-?\d+)\)", s)
-
-                if pass_type == "initial":
-                    ox, oy = (int(off_m.group(1)), int(off_m.group(2))) if off_m else (0, 0)
-                    mat4_to_weights(vals, weight, out_start, 0, ox + 1, oy + 1, n_in=4)
-
-                elif pass_type == "hidden":
-                    ox, oy = (int(off_m.group(1)), int(off_m.group(2))) if off_m else (0, 0)
-                    in_start = (num_feat + sampler_idx * 4) if is_neg else (sampler_idx * 4)
-                    mat4_to_weights(vals, weight, out_start, in_start, ox + 1, oy + 1)
-
-                elif pass_type == "aggregation":
-                    layer_idx = sampler_idx // n_tpg
-                    tex_idx = sampler_idx % n_tpg
-                    if is_neg:
-                        in_start = layer_idx * num_feat * factor + num_feat + tex_idx * 4
-                    else:
-                        in_start = layer_idx * num_feat * factor + tex_idx * 4
-                    if tail_kernel == 1:
-                        ky, kx = 0, 0
-                    else:
-                        ox, oy = (int(off_m.group(1)), int(off_m.group(2))) if off_m else (0, 0)
-                        half = tail_kernel // 2
-                        ky, kx = ox + half, oy + half
-                    mat4_to_weights(vals, weight, out_start, in_start, ky, kx)
+    # Collect literals per tensor, parsed together once all passes are read
+    head_w = BlockLiterals((num_feat, 3, 3, 3))
+    head_b = BlockLiterals((num_feat,))
+    mid_ws = [BlockLiterals((num_feat, num_feat * factor, 3, 3)) for _ in range(block_depth - 1)]
+    mid_bs = [BlockLiterals((num_feat,)) for _ in range(block_depth - 1)]
+    tail_w = BlockLiterals((12, num_feat * factor * n_stack, tail_kernel, tail_kernel))
+    tail_b = BlockLiterals((12,))
+
+    def parse_and_fill(body, weight, bias, pass_type):
+        """Route mat4/vec4 literals of one pass to the weight/bias blocks."""
+        for kind, m in body:
+            if kind == "bias":
+                bias[int(m["bias_out"])] = m["bias_vals"]
+                continue
+            if kind != "mat":
                 continue
 
-            # bias line (vec4 without mat4)
-            if "mat4" not in s:
-                bias_m = re.search(r"result(\d+)\s*\+=\s*vec4\(([^)]+)\)", s)
-                if bias_m:
-                    result_idx = int(bias_m.group(1))
-                    vals = _parse_float_list(bias_m.group(2))
-                    out_start = result_idx * 4
-                    for k2 in range(4):
-                        if out_start + k2 < bias.shape[0]:
-                            bias[out_start + k2] = vals[k2]
+            out_block = int(m["mat_out"])
+            tail = m["mat_tail"]
+            is_neg = "max(-sample" in tail
+            samp_m = SAMPLER.search(tail)
+            sampler_idx = int(samp_m.group(1)) if samp_m else 0
+            off_m = OFFSET.search(tail)
+            ox, oy = (int(off_m.group(1)), int(off_m.group(2))) if off_m else (0, 0)
+
+            if pass_type == "initial":
+                weight[out_block, 0, ox + 1, oy + 1] = m["mat_vals"]
+
+            elif pass_type == "hidden":
+                in_block = (n_tpg + sampler_idx) if is_neg else sampler_idx
+                weight[out_block, in_block, ox + 1, oy + 1] = m["mat_vals"]
+
+            elif pass_type == "aggregation":
+                layer_idx, tex_idx = divmod(sampler_idx, n_tpg)
+                in_block = layer_idx * n_tpg * factor + tex_idx
+                if is_neg:
+                    in_block += n_tpg
+                if tail_kernel == 1:
+                    ky, kx = 0, 0
+                else:
+                    half = tail_kernel // 2
+                    ky, kx = ox + half, oy + half
+                weight[out_block, in_block, ky, kx] = m["mat_vals"]
 
     # Parse each pass
     parse_and_fill(pass_blocks[0], head_w, head_b, "initial")
@@ -140,9 +134,9 @@ def parse_comp(path: str) -> Anime4KCNN:
     return Anime4KCNN(
         num_feat=num_feat, block_depth=block_depth, factor=factor,
         n_stack=n_stack, tail_kernel=tail_kernel,
-        head_weight=head_w, head_bias=head_b,
-        mid_weights=mid_ws, mid_biases=mid_bs,
-        tail_weight=tail_w, tail_bias=tail_b,
+        head_weight=head_w.array(), head_bias=head_b.array(),
+        mid_weights=[w.array() for w in mid_ws], mid_biases=[b.array() for b in mid_bs],
+        tail_weight=tail_w.array(), tail_bias=tail_b.array(),
     )
 
 
@@ -2,51 +2,52 @@
 
 import re
 
-import numpy as np
-
 from ..ir import Anime4KCNN
-from ..utils import _parse_float_list, mat4_to_weights
+from .tokens import BlockLiterals, Tokenizer
+
+
+GLSL_TOKENS = Tokenizer(
+    "/#m+=",
+    directive=r"//!(?P<directive_name>[A-Z]+) (?P<directive_arg>.*)",
+    define=r"#define .*",
+    # result += mat4(values) * go_N(ox, oy) / g_N
+    mat=r"mat4\((?P<mat_vals>[^)]+)\)(?P<mat_tail>.*)",
+    # result += vec4(bias)
+    bias=r"(?:\+=\s*|= )vec4\((?P<bias_vals>[^)]+)\)",
+)
+
+GO_CALL = re.compile(r"go_(\d+)\(\s*(-?[\d.]+)\s*,\s*(-?[\d.]+)\s*\)")
+G_NAME = re.compile(r"\bg_(\d+)\b")
+GO_DEFINE = re.compile(r"#define go_(\d+)\(x_off,\s*y_off\)\s+(.*)")
+G_DEFINE = re.compile(r"#define g_(\d+)\s+(.*)")
 
 
 def _parse_mpv_passes(text: str) -> list[dict]:
-    """Parse mpv GLSL into a list of pass dicts."""
+    """Parse mpv GLSL into a list of pass dicts in one scan of the text."""
     passes = []
     cur = None
-    for line in text.splitlines():
-        s = line.strip()
-        if s.startswith("//!DESC "):
-            if cur is not None:
+    for kind, m in GLSL_TOKENS.tokens(text):
+        if kind == "directive":
+            directive, arg = m["directive_name"], m["directive_arg"].rstrip()
+            if directive == "DESC":
+                cur = {"desc": arg, "hook": "", "binds": [], "save": "",
+                       "width": "", "height": "", "components": 4,
+                       "defines": [], "body": []}
                 passes.append(cur)
-            cur = {"desc": s[8:], "hook": "", "binds": [], "save": "",
-                   "width": "", "height": "", "components": 4,
-                   "defines": [], "body": []}
-            continue
-        if cur is None:
+            elif cur is None:
+                continue
+            elif directive == "BIND":
+                cur["binds"].append(arg)
+            elif directive == "COMPONENTS":
+                cur["components"] = int(arg)
+            elif directive in ("HOOK", "SAVE", "WIDTH", "HEIGHT"):
+                cur[directive.lower()] = arg
+        elif cur is None:
             continue
-        if s.startswith("//!HOOK "):
-            cur["hook"] = s[8:]
-        elif s.startswith("//!BIND "):
-            cur["binds"].append(s[8:])
-        elif s.startswith("//!SAVE "):
-            cur["save"] = s[8:]
-        elif s.startswith("//!WIDTH "):
-            cur["width"] = s[9:]
-        elif s.startswith("//!HEIGHT "):
-            cur["height"] = s[10:]
-        elif s.startswith("//!COMPONENTS "):
-            cur["components"] = int(s[14:])
-        elif s.startswith("//!WHEN "):
-            pass
-        elif s.startswith("#define "):
-            cur["defines"].append(s)
-        elif s.startswith("vec4 hook()"):
-            pass
-        elif s in ("return result;", "return result0;", "}"):
-            pass
+        elif kind == "define":
+            cur["defines"].append(m[0].rstrip())
         else:
-            cur["body"].append(line)
-    if cur is not None:
-        passes.append(cur)
+            cur["body"].append((kind, m))
     return passes
 
 
@@ -91,7 +92,7 @@ def _parse_go_defines(defines: list[str]) -> dict:
     result = {}
     for d in defines:
         # Function-like: #define go_N(x_off, y_off) ...
-        m = re.match(r"#define go_(\d+)\(x_off,\s*y_off\)\s+(.*)", d)
+        m = GO_DEFINE.match(d)
         if m:
             idx = int(m.group(1))
             expr = m.group(2)
@@ -102,7 +103,7 @@ def _parse_go_defines(defines: list[str]) -> dict:
             result[idx] = (tex_name, True if is_neg else (False if is_pos else None))
             continue
         # Object-like: #define g_N ...
-        m = re.match(r"#define g_(\d+)\s+(.*)", d)
+        m = G_DEFINE.match(d)
         if m:
             idx = int(m.group(1))
             expr = m.group(2)
@@ -119,13 +120,10 @@ def parse_glsl(path: str) -> Anime4KCNN:
     with open(path) as f:
         text = f.read()
 
-    # Strip license header
-    desc_pos = text.find("//!DESC ")
-    if desc_pos == -1:
+    # The license header before the first //!DESC is skipped by the scan
+    passes = _parse_mpv_passes(text)
+    if not passes:
         raise ValueError("No //!DESC directives found")
-    shader_text = text[desc_pos:]
-
-    passes = _parse_mpv_passes(shader_text)
     groups = _group_glsl_passes(passes)
 
     # Classify groups
@@ -163,25 +161,29 @@ def parse_glsl(path: str) -> Anime4KCNN:
     else:
         n_stack = 5
 
-    # Allocate tensors
-    head_w = np.zeros((num_feat, 3, 3, 3), dtype=np.float32)
-    head_b = np.zeros(num_feat, dtype=np.float32)
-    mid_ws = [np.zeros((num_feat, num_feat * factor, 3, 3), dtype=np.float32)
-              for _ in range(block_depth - 1)]
-    mid_bs = [np.zeros(num_feat, dtype=np.float32) for _ in range(block_depth - 1)]
-    tail_in = num_feat * factor * n_stack
-    tail_w = np.zeros((12, tail_in, tail_kernel, tail_kernel), dtype=np.float32)
-    tail_b = np.zeros(12, dtype=np.float32)
+    # Collect literals per tensor, parsed together once all passes are read
+    head_w = BlockLiterals((num_feat, 3, 3, 3))
+    head_b = BlockLiterals((num_feat,))
+    mid_ws = [BlockLiterals((num_feat, num_feat * factor, 3, 3)) for _ in range(block_depth - 1)]
+    mid_bs = [BlockLiterals((num_feat,)) for _ in range(block_depth - 1)]
+    tail_w = BlockLiterals((12, num_feat * factor * n_stack, tail_kernel, tail_kernel))
+    tail_b = BlockLiterals((12,))
 
     hidden_idx = 0
     for gi, g in enumerate(groups):
         ptype = types[gi]
 
-        if ptype == "depth_to_space":
+        if ptype == "initial_conv":
+            weight, bias = head_w, head_b
+        elif ptype == "hidden_layer":
+            weight, bias = mid_ws[hidden_idx], mid_bs[hidden_idx]
+            hidden_idx += 1
+        elif ptype == "aggregation":
+            weight, bias = tail_w, tail_b
+        else:
             continue
 
-        for sub_idx, mpv_pass in enumerate(g):
-            out_start = sub_idx * 4
+        for out_block, mpv_pass in enumerate(g):
             go_map = _parse_go_defines(mpv_pass["defines"])
 
             # Build sampler map: texture_name -> sampler_idx
@@ -194,79 +196,49 @@ def parse_glsl(path: str) -> Anime4KCNN:
                 elif ptype == "initial_conv":
                     sampler_map["MAIN"] = 0
 
-            for body_line in mpv_pass["body"]:
-                s = body_line.strip()
-                if not s:
+            for kind, m in mpv_pass["body"]:
+                if kind == "bias":
+                    bias[out_block] = m["bias_vals"]
                     continue
 
-                # Parse mat4 line
-                mat_m = re.search(r"mat4\(([^)]+)\)", s)
-                if mat_m:
-                    vals = _parse_float_list(mat_m.group(1))
-
-                    if ptype == "initial_conv":
-                        # go_0(ox, oy) -> MAIN
-                        go_call = re.search(r"go_(\d+)\(\s*(-?[\d.]+)\s*,\s*(-?[\d.]+)\s*\)", s)
-                        if go_call:
-                            ox = int(float(go_call.group(2)))
-                            oy = int(float(go_call.group(3)))
-                            mat4_to_weights(vals, head_w, out_start, 0, ox + 1, oy + 1, n_in=4)
-
-                    elif ptype == "hidden_layer":
-                        go_call = re.search(r"go_(\d+)\(\s*(-?[\d.]+)\s*,\s*(-?[\d.]+)\s*\)", s)
-                        if go_call:
-                            go_idx = int(go_call.group(1))
-                            ox = int(float(go_call.group(2)))
-                            oy = int(float(go_call.group(3)))
-                            tex_name, is_neg = go_map[go_idx]
-                            samp_idx = sampler_map.get(tex_name, 0)
-                            in_start = (num_feat + samp_idx * 4) if is_neg else (samp_idx * 4)
-                            mat4_to_weights(vals, mid_ws[hidden_idx], out_start, in_start, ox + 1, oy + 1)
-
-                    elif ptype == "aggregation":
-                        g_call = re.search(r"\bg_(\d+)\b", s)
-                        if g_call:
-                            g_idx = int(g_call.group(1))
-                            tex_name, is_neg = go_map[g_idx]
-                            samp_idx = sampler_map.get(tex_name, 0)
-                            layer_idx = samp_idx // n_textures
-                            tex_idx = samp_idx % n_textures
-                            if is_neg:
-                                in_start = layer_idx * num_feat * factor + num_feat + tex_idx * 4
-                            else:
-                                in_start = layer_idx * num_feat * factor + tex_idx * 4
-                            if tail_kernel == 1:
-                                ky, kx = 0, 0
-                            else:
-                                # For 3x3 aggregation, would need spatial offset extraction
-                                ky, kx = 0, 0
-                            mat4_to_weights(vals, tail_w, out_start, in_start, ky, kx)
-                    continue
-
-                # Parse bias line
-                if "mat4" not in s:
-                    bias_m = re.search(r"vec4\(([^)]+)\)", s)
-                    if bias_m and ("+=" in s or "= vec4" in s):
-                        bvals = _parse_float_list(bias_m.group(1))
-                        if ptype == "initial_conv":
-                            for k2 in range(4):
-                                head_b[out_start + k2] = bvals[k2]
-                        elif ptype == "hidden_layer":
-                            for k2 in range(4):
-                                mid_bs[hidden_idx][out_start + k2] = bvals[k2]
-                        elif ptype == "aggregation":
-                            for k2 in range(4):
-                                tail_b[out_start + k2] = bvals[k2]
-
-        if ptype == "hidden_layer":
-            hidden_idx += 1
+                if ptype == "initial_conv":
+                    # go_0(ox, oy) -> MAIN
+                    go_call = GO_CALL.search(m["mat_tail"])
+                    if go_call:
+                        ox = int(float(go_call.group(2)))
+                        oy = int(float(go_call.group(3)))
+                        weight[out_block, 0, ox + 1, oy + 1] = m["mat_vals"]
+
+                elif ptype == "hidden_layer":
+                    go_call = GO_CALL.search(m["mat_tail"])
+                    if go_call:
+                        go_idx = int(go_call.group(1))
+                        ox = int(float(go_call.group(2)))
+                        oy = int(float(go_call.group(3)))
+                        tex_name, is_neg = go_map[go_idx]
+                        samp_idx = sampler_map.get(tex_name, 0)
+                        in_block = (num_feat // 4 + samp_idx) if is_neg else samp_idx
+                        weight[out_block, in_block, ox + 1, oy + 1] = m["mat_vals"]
+
+                else:
+                    g_call = G_NAME.search(m["mat_tail"])
+                    if g_call:
+                        g_idx = int(g_call.group(1))
+                        tex_name, is_neg = go_map[g_idx]
+                        samp_idx = sampler_map.get(tex_name, 0)
+                        layer_idx, tex_idx = divmod(samp_idx, n_textures)
+                        in_block = layer_idx * n_textures * factor + tex_idx
+                        if is_neg:
+                            in_block += n_textures
+                        # For 3x3 aggregation, would need spatial offset extraction
+                        weight[out_block, in_block, 0, 0] = m["mat_vals"]
 
     return Anime4KCNN(
         num_feat=num_feat, block_depth=block_depth, factor=factor,
         n_stack=n_stack, tail_kernel=tail_kernel,
-        head_weight=head_w, head_bias=head_b,
-        mid_weights=mid_ws, mid_biases=mid_bs,
-        tail_weight=tail_w, tail_bias=tail_b,
+        head_weight=head_w.array(), head_bias=head_b.array(),
+        mid_weights=[w.array() for w in mid_ws], mid_biases=[b.array() for b in mid_bs],
+        tail_weight=tail_w.array(), tail_bias=tail_b.array(),
     )
 
 
@@ -2,10 +2,27 @@
 
 import re
 
-import numpy as np
-
 from ..ir import Anime4KCNN
-from ..utils import _parse_float_list, mat4_to_weights, HLSL_LETTER_OFFSETS
+from ..utils import HLSL_LETTER_OFFSETS
+from .tokens import BlockLiterals, Tokenizer
+
+HLSL_TOKENS = Tokenizer(
+    "/vMt[m",
+    pass_start=r"//!PASS\s+\d+",
+    desc=r"//!DESC (?P<desc_text>.*)",
+    inputs=r"//!IN (?P<in_list>.*)",
+    outputs=r"//!OUT (?P<out_list>.*)",
+    body=r"void Pass\d+\(",
+    # Initial and aggregation passes: MF4 targetN = { bias } or MF4 targetN = MF4(bias)
+    target_bias=r"MF4\s+target(?P<bias_target>\d+)\s*=\s*(?:MF4\((?P<bias_call>[^)]+)\)|\{\s*(?P<bias_brace>[^}]+)\s*\})",
+    # Hidden passes: [MF4 ]target = MF4(bias)
+    hidden_bias=r"(?:MF4\s+)?target\s*=\s*MF4\((?P<hidden_bias_vals>[^)]+)\)",
+    src_muladd=r"MulAdd\(src\[i\s*(?P<di>[+-]\s*\d+)?\]\[j\s*(?P<dj>[+-]\s*\d+)?\],\s*MF3x4\((?P<src_vals>[^)]+)\),\s*target(?P<src_target>\d+)\)",
+    letter_muladd=r"MulAdd\((?P<neg>n?)(?P<letter>[a-i])(?P<tex>\d+),\s*MF4x4\((?P<letter_vals>[^)]+)\),\s*target\)",
+    g_muladd=r"MulAdd\((?P<g_prefix>n?g)(?P<g_idx>\d+),\s*MF4x4\((?P<g_vals>[^)]+)\),\s*target(?P<g_target>\d+)\)",
+    write=r"\[(?:gxy|destPos)\]\s*=\s*target",
+    crelu=r"max\(-",
+)
 
 
 def parse_hlsl(path: str) -> Anime4KCNN:
@@ -13,41 +30,28 @@ def parse_hlsl(path: str) -> Anime4KCNN:
     with open(path, encoding="utf-8") as f:
         text = f.read()
 
-    lines = text.splitlines()
-
-    # Count passes and find their line ranges
-    pass_starts = []
-    for i, line in enumerate(lines):
-        if re.match(r"//!PASS\s+\d+", line.strip()):
-            pass_starts.append(i)
-
-    # Extract pass info: desc, in, out, body
+    # Extract pass info in one scan: desc, in, out and the body tokens
     pass_info_list = []
-    for pi, start in enumerate(pass_starts):
-        end = pass_starts[pi + 1] if pi + 1 < len(pass_starts) else len(lines)
-        desc = ""
-        in_textures = []
-        out_textures = []
-        body_lines = []
-        in_body = False
-
-        for j in range(start, end):
-            s = lines[j].strip()
-            if s.startswith("//!DESC "):
-                desc = s[8:]
-            elif s.startswith("//!IN "):
-                in_textures = [x.strip() for x in s[6:].split(",")]
-            elif s.startswith("//!OUT "):
-                out_textures = [x.strip() for x in s[7:].split(",")]
-            elif re.match(r"void Pass\d+\(", s):
-                in_body = True
-            elif in_body:
-                body_lines.append(lines[j])
-
-        pass_info_list.append({
-            "desc": desc, "in": in_textures, "out": out_textures,
-            "body": body_lines
-        })
+    cur = None
+    for kind, m in HLSL_TOKENS.tokens(text):
+        if kind == "pass_start":
+            cur = {"desc": "", "in": [], "out": [], "body": [], "has_neg": False, "in_body": False}
+            pass_info_list.append(cur)
+        elif cur is None:
+            continue
+        elif kind == "desc":
+            cur["desc"] = m["desc_text"].rstrip()
+        elif kind == "inputs":
+            cur["in"] = [x.strip() for x in m["in_list"].split(",")]
+        elif kind == "outputs":
+            cur["out"] = [x.strip() for x in m["out_list"].split(",")]
+        elif kind == "body":
+            cur["in_body"] = True
+        elif cur["in_body"]:
+            if kind == "crelu":
+                cur["has_neg"] = True
+            else:
+                cur["body"].append((kind, m))
 
     total_passes = len(pass_info_list)
 
@@ -70,8 +74,7 @@ def parse_hlsl(path: str) -> Anime4KCNN:
 
     # Detect factor from hidden layer body (presence of na1, nb1 etc.)
     if hidden_count > 0:
-        has_neg = any("max(-" in line for line in pass_info_list[1]["body"])
-        factor = 2 if has_neg else 1
+        factor = 2 if pass_info_list[1]["has_neg"] else 1
 
     # Tail kernel from aggregation desc
     tail_kernel = 1
@@ -84,15 +87,14 @@ def parse_hlsl(path: str) -> Anime4KCNN:
     agg_in = [t for t in pass_info_list[-1]["in"] if t != "INPUT"]
     n_stack = len(agg_in) // n_textures
 
-    # Allocate tensors
-    head_w = np.zeros((num_feat, 3, 3, 3), dtype=np.float32)
-    head_b = np.zeros(num_feat, dtype=np.float32)
-    mid_ws = [np.zeros((num_feat, num_feat * factor, 3, 3), dtype=np.float32)
-              for _ in range(block_depth - 1)]
-    mid_bs = [np.zeros(num_feat, dtype=np.float32) for _ in range(block_depth - 1)]
+    # Collect literals per tensor, parsed together once all passes are read
+    head_w = BlockLiterals((num_feat, 3, 3, 3), n_in=3)
+    head_b = BlockLiterals((num_feat,))
+    mid_ws = [BlockLiterals((num_feat, num_feat * factor, 3, 3)) for _ in range(block_depth - 1)]
+    mid_bs = [BlockLiterals((num_feat,)) for _ in range(block_depth - 1)]
     tail_in = num_feat * factor * n_stack
-    tail_w = np.zeros((12, tail_in, tail_kernel, tail_kernel), dtype=np.float32)
-    tail_b = np.zeros(12, dtype=np.float32)
+    tail_w = BlockLiterals((12, tail_in, tail_kernel, tail_kernel))
+    tail_b = BlockLiterals((12,))
 
     # ─── Parse Pass 1 (initial conv) ───
     _parse_hlsl_initial(pass_info_list[0]["body"], head_w, head_b, num_feat)
@@ -109,163 +111,67 @@ def parse_hlsl(path: str) -> Anime4KCNN:
     return Anime4KCNN(
         num_feat=num_feat, block_depth=block_depth, factor=factor,
         n_stack=n_stack, tail_kernel=tail_kernel,
-        head_weight=head_w, head_bias=head_b,
-        mid_weights=mid_ws, mid_biases=mid_bs,
-        tail_weight=tail_w, tail_bias=tail_b,
+        head_weight=head_w.array(), head_bias=head_b.array(),
+        mid_weights=[w.array() for w in mid_ws], mid_biases=[b.array() for b in mid_bs],
+        tail_weight=tail_w.array(), tail_bias=tail_b.array(),
     )
 
 
-def _parse_hlsl_initial(body_lines: list[str], weight: np.ndarray,
-                        bias: np.ndarray, num_feat: int) -> None:
+def _parse_hlsl_initial(body: list, weight: BlockLiterals,
+                        bias: BlockLiterals, num_feat: int) -> None:
     """Parse HLSL initial conv pass (MF3x4 with src[i][j] spatial sampling)."""
     # Spatial mapping: src[i+di][j+dj] -> offset (di, dj)
     # We parse: MulAdd(src[...][...], MF3x4(values), targetN)
     # and: MF4 targetN = { bias } or MF4 targetN = MF4(bias)
+    for kind, m in body:
+        if kind == "target_bias":
+            bias[int(m["bias_target"]) - 1] = m["bias_call"] or m["bias_brace"]
 
-    src_pattern = re.compile(
-        r"MulAdd\(src\[i\s*([+-]\s*\d+)?\]\[j\s*([+-]\s*\d+)?\],\s*MF3x4\(([^)]+)\),\s*target(\d+)\)"
-    )
-    bias_pattern = re.compile(
-        r"MF4\s+target(\d+)\s*=\s*(?:MF4\(([^)]+)\)|\{\s*([^}]+)\s*\})"
-    )
-
-    for line in body_lines:
-        s = line.strip()
-
-        # Parse bias initialization
-        bm = bias_pattern.search(s)
-        if bm:
-            tidx = int(bm.group(1))
-            vals_str = bm.group(2) or bm.group(3)
-            bvals = _parse_float_list(vals_str)
-            out_start = (tidx - 1) * 4
-            for k2 in range(4):
-                if out_start + k2 < bias.shape[0]:
-                    bias[out_start + k2] = bvals[k2]
-            continue
-
-        # Parse MulAdd with MF3x4
-        sm = src_pattern.search(s)
-        if sm:
-            di_str = sm.group(1)
-            dj_str = sm.group(2)
-            vals = _parse_float_list(sm.group(3))
-            tidx = int(sm.group(4))
-
-            di = int(di_str.replace(" ", "")) if di_str else 0
-            dj = int(dj_str.replace(" ", "")) if dj_str else 0
-            ky, kx = di + 1, dj + 1
-            out_start = (tidx - 1) * 4
-            mat4_to_weights(vals, weight, out_start, 0, ky, kx, n_in=3)
+        elif kind == "src_muladd":
+            di = int(m["di"].replace(" ", "")) if m["di"] else 0
+            dj = int(m["dj"].replace(" ", "")) if m["dj"] else 0
+            weight[int(m["src_target"]) - 1, 0, di + 1, dj + 1] = m["src_vals"]
 
 
-def _parse_hlsl_hidden(body_lines: list[str], weight: np.ndarray,
-                       bias: np.ndarray, num_feat: int, factor: int) -> None:
+def _parse_hlsl_hidden(body: list, weight: BlockLiterals,
+                       bias: BlockLiterals, num_feat: int, factor: int) -> None:
     """Parse HLSL hidden layer pass (MulAdd with MF4x4, a1..i3, na1..ni3 vars)."""
-    # Patterns for MulAdd(var, MF4x4(values), target)
-    muladd_pattern = re.compile(
-        r"MulAdd\((n?)([a-i])(\d+),\s*MF4x4\(([^)]+)\),\s*target\)"
-    )
-    bias_pattern = re.compile(
-        r"(?:MF4\s+)?target\s*=\s*MF4\(([^)]+)\)"
-    )
-    write_pattern = re.compile(r"(\w+)\[(?:gxy|destPos)\]\s*=\s*target")
-
     current_out = 0  # current output texture index (0, 1, 2)
 
-    for line in body_lines:
-        s = line.strip()
-
-        # Bias initialization
-        bm = bias_pattern.search(s)
-        if bm:
-            vals_str = bm.group(1)
-            bvals = _parse_float_list(vals_str)
-            out_start = current_out * 4
-            for k2 in range(4):
-                if out_start + k2 < bias.shape[0]:
-                    bias[out_start + k2] = bvals[k2]
-            continue
-
-        # MulAdd line
-        mm = muladd_pattern.search(s)
-        if mm:
-            is_neg = mm.group(1) == "n"
-            letter = mm.group(2)
-            tex_digit = int(mm.group(3))
-            vals = _parse_float_list(mm.group(4))
-
-            ox, oy = HLSL_LETTER_OFFSETS[letter]
-            ky, kx = ox + 1, oy + 1
-            sampler_idx = tex_digit - 1  # 1-indexed -> 0-indexed
-            out_start = current_out * 4
-
-            if is_neg:
-                in_start = num_feat + sampler_idx * 4
-            else:
-                in_start = sampler_idx * 4
+    for kind, m in body:
+        if kind == "hidden_bias":
+            bias[current_out] = m["hidden_bias_vals"]
 
-            mat4_to_weights(vals, weight, out_start, in_start, ky, kx)
-            continue
+        elif kind == "letter_muladd":
+            ox, oy = HLSL_LETTER_OFFSETS[m["letter"]]
+            sampler_idx = int(m["tex"]) - 1  # 1-indexed -> 0-indexed
+            in_block = num_feat // 4 + sampler_idx if m["neg"] else sampler_idx
+            weight[current_out, in_block, ox + 1, oy + 1] = m["letter_vals"]
 
         # Write target -> advance output index
-        wm = write_pattern.search(s)
-        if wm:
+        elif kind == "write":
             current_out += 1
 
 
-def _parse_hlsl_aggregation(body_lines: list[str], weight: np.ndarray,
-                            bias: np.ndarray, num_feat: int, factor: int,
+def _parse_hlsl_aggregation(body: list, weight: BlockLiterals,
+                            bias: BlockLiterals, num_feat: int, factor: int,
                             n_stack: int, tail_kernel: int) -> None:
     """Parse HLSL aggregation+DTS pass (last pass with target1/2/3 and g0..gN, ng0..ngN)."""
     n_tpg = num_feat // 4
 
-    muladd_pattern = re.compile(
-        r"MulAdd\((n?g)(\d+),\s*MF4x4\(([^)]+)\),\s*target(\d+)\)"
-    )
-    bias_pattern = re.compile(
-        r"MF4\s+target(\d+)\s*=\s*MF4\(([^)]+)\)"
-    )
-
-    for line in body_lines:
-        s = line.strip()
-
-        # Bias initialization
-        bm = bias_pattern.search(s)
-        if bm:
-            tidx = int(bm.group(1))
-            bvals = _parse_float_list(bm.group(2))
-            out_start = (tidx - 1) * 4
-            for k2 in range(4):
-                if out_start + k2 < bias.shape[0]:
-                    bias[out_start + k2] = bvals[k2]
-            continue
-
-        # MulAdd line
-        mm = muladd_pattern.search(s)
-        if mm:
-            var_prefix = mm.group(1)
-            g_idx = int(mm.group(2))
-            vals = _parse_float_list(mm.group(3))
-            tidx = int(mm.group(4))
-
-            is_neg = var_prefix == "ng"
-            out_start = (tidx - 1) * 4
+    for kind, m in body:
+        if kind == "target_bias" and m["bias_call"]:
+            bias[int(m["bias_target"]) - 1] = m["bias_call"]
 
+        elif kind == "g_muladd":
             # Map g_idx to (layer_idx, tex_idx)
-            layer_idx = g_idx // n_tpg
-            tex_idx = g_idx % n_tpg
+            layer_idx, tex_idx = divmod(int(m["g_idx"]), n_tpg)
+            in_block = layer_idx * n_tpg * factor + tex_idx
+            if m["g_prefix"] == "ng":
+                in_block += n_tpg
 
-            if is_neg:
-                in_start = layer_idx * num_feat * factor + num_feat + tex_idx * 4
-            else:
-                in_start = layer_idx * num_feat * factor + tex_idx * 4
-
-            if tail_kernel == 1:
-                ky, kx = 0, 0
-            else:
-                ky, kx = 0, 0  # For 3x3 tail, would need spatial parsing
-            mat4_to_weights(vals, weight, out_start, in_start, ky, kx)
+            # For 3x3 tail, would need spatial parsing
+            weight[int(m["g_target"]) - 1, in_block, 0, 0] = m["g_vals"]
 
 
 __all__ = ["parse_hlsl"]
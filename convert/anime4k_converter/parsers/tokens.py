@@ -0,0 +1,83 @@
+"""Single-pass tokenizer and literal scanner shared by the shader parsers."""
+
+import re
+
+import numpy as np
+
+from ..utils import blocks_to_weight, weight_to_blocks
+
+
+class Tokenizer:
+    """Scan shader text once for a fixed set of named token patterns.
+
+    The patterns are compiled into one alternation in MULTILINE mode, so
+    `tokens` walks the text a single time and yields `(name, match)` in
+    source order. Earlier patterns win at the same position, and group names
+    inside the patterns must be unique across all of them.
+
+    `starts` lists every character a token can begin with. A lookahead on it
+    rejects all other positions in one step instead of trying each pattern
+    there, which is most of the scan time on large shaders.
+    """
+
+    def __init__(self, starts: str, **patterns: str):
+        alternatives = "|".join(f"(?P<{name}>{pattern})" for name, pattern in patterns.items())
+        self.regex = re.compile(f"(?=[{re.escape(starts)}])(?:{alternatives})", re.MULTILINE)
+
+    def tokens(self, text: str):
+        for m in self.regex.finditer(text):
+            yield m.lastgroup, m
+
+
+def parse_floats(literals: list[str], width: int) -> np.ndarray:
+    """Parse comma-separated literal lists into a preallocated float32 [len(literals), width] array.
+
+    All lists are joined and converted by one C-level scan instead of a
+    Python float() call per value, with the same correctly rounded result.
+    """
+    out = np.zeros((len(literals), width), dtype=np.float32)
+    if literals:
+        values = np.fromstring(",".join(literals), dtype=np.float64, sep=",")
+        if values.size != out.size:
+            raise ValueError(f"Expected {width} values per literal, got {values.size} in {len(literals)} literals")
+        out.ravel()[:] = values
+    return out
+
+
+class BlockLiterals:
+    """Literal strings of one weight or bias tensor, keyed by block and parsed in one go.
+
+    Weights use the weight_to_blocks index `[out_block, in_block, ky, kx]`
+    with one mat4/MF4x4 (n_in=4) or MF3x4 (n_in=3) literal per block. Biases
+    use the vec4/MF4 index `out_start // 4`. A later literal for the same block
+    replaces the earlier one. Indices follow NumPy rules (negative ones count
+    from the end) and blocks outside the tensor are ignored.
+    """
+
+    def __init__(self, shape: tuple, n_in: int = 4):
+        self.shape = shape
+        self.n_in = n_in
+        self.literals = {}
+
+    def __setitem__(self, index, literal: str) -> None:
+        self.literals[index] = literal
+
+    def array(self) -> np.ndarray:
+        if len(self.shape) == 1:
+            blocks = np.zeros((-(-self.shape[0] // 4), 4), dtype=np.float32)
+            width = 4
+        else:
+            blocks = weight_to_blocks(np.zeros(self.shape, dtype=np.float32), self.n_in)
+            width = 4 * self.n_in
+        if self.literals:
+            index = np.array(list(self.literals), dtype=np.int64).reshape(len(self.literals), -1)
+            dims = np.array(blocks.shape[:index.shape[1]])
+            inside = np.all((index >= -dims) & (index < dims), axis=1)
+            values = parse_floats(list(self.literals.values()), width)
+            blocks[tuple(index[inside].T)] = values[inside].reshape(-1, *blocks.shape[index.shape[1]:])
+        if len(self.shape) == 1:
+            return blocks.ravel()[:self.shape[0]].copy()
+        return blocks_to_weight(blocks, self.shape)
+
+
+__all__ = ["BlockLiterals", "Tokenizer", "parse_floats"]
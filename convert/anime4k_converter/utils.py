@@ -1,6 +1,7 @@
 """Shared utilities for parsing and writing Anime4K CNN formats."""
 
 import struct
+from dataclasses import replace
 
 import numpy as np
 
@@ -25,6 +26,82 @@ def format_float(value: float) -> str:
     return s
 
 
+# float32 bit pattern -> format_float string, shared by every format_floats call
+_FORMATTED: dict[int, str] = {}
+_FORMATTED_MAX = 1 << 20
+
+
+def _format_bits(bits: np.ndarray) -> list[str]:
+    """format_float for a 1D array of float32 bit patterns.
+
+    NumPy's float32 -> str cast gives the shortest round-trip digits of every
+    value in one C loop. No `%g` string with fewer digits can round-trip, so
+    the precision search starts there instead of at 1; almost every value
+    then round-trips on the first try, checked for the whole batch at once.
+    """
+    values = bits.view(np.float32)
+    floats = values.astype(np.float64).tolist()
+    result = [None] * len(floats)
+    finite = np.isfinite(values)
+    for i in np.flatnonzero(~finite).tolist():
+        result[i] = format_float(floats[i])
+
+    todo = np.flatnonzero(finite)
+    digits = np.array([
+        len(s.partition("e")[0].lstrip("-").replace(".", "").strip("0")) or 1
+        for s in values[todo].astype(str).tolist()
+    ], dtype=np.int64)
+    while todo.size:
+        last = digits > 14
+        for i in todo[last].tolist():
+            result[i] = "%.9g" % floats[i]
+        todo, digits = todo[~last], digits[~last]
+        text = ["%.*g" % (d, floats[i]) for i, d in zip(todo.tolist(), digits.tolist())]
+        parsed = np.array([float(t) for t in text], dtype=np.float64)
+        ok = parsed.astype(np.float32).view(np.uint32) == bits[todo]
+        for i, t in zip(todo[ok].tolist(), np.asarray(text, dtype=object)[ok].tolist()):
+            result[i] = t
+        todo, digits = todo[~ok], digits[~ok] + 1
+
+    return [s if "." in s or "e" in s else s + ".0" for s in result]
+
+
+def format_floats(values) -> np.ndarray:
+    """Vectorised format_float: an object array of strings with the shape of `values`.
+
+    Byte-identical to calling format_float on every element. Each distinct
+    float32 value is formatted once and memoised across calls, so writers
+    can convert a whole weight tensor up front.
+    """
+    bits = np.array(values, dtype=np.float32).view(np.uint32)
+    unique, inverse = np.unique(bits.ravel(), return_inverse=True)
+    keys = unique.tolist()
+    missing = [k for k in keys if k not in _FORMATTED]
+    if missing:
+        if len(_FORMATTED) + len(missing) > _FORMATTED_MAX:
+            _FORMATTED.clear()
+        _FORMATTED.update(zip(missing, _format_bits(np.array(missing, dtype=np.uint32))))
+    strings = np.array([_FORMATTED[k] for k in keys], dtype=object)
+    return strings[inverse.ravel()].reshape(bits.shape)
+
+
+def format_model(ir: Anime4KCNN) -> Anime4KCNN:
+    """Copy of `ir` whose weights and biases are `format_floats` string arrays.
+
+    Writers format the whole model once up front and then only slice and
+    join strings per block.
+    """
+    return replace(
+        ir,
+        head_weight=format_floats(ir.head_weight),
+        head_bias=format_floats(ir.head_bias),
+        mid_weights=[format_floats(w) for w in ir.mid_weights],
+        mid_biases=[format_floats(b) for b in ir.mid_biases],
+        tail_weight=format_floats(ir.tail_weight),
+        tail_bias=format_floats(ir.tail_bias),
+    )
+
+
 def variant_label(ir: Anime4KCNN) -> str:
     """Generate a variant label (UL, VL, L, M, S) from architecture parameters."""
     known = {
@@ -51,91 +128,54 @@ def conv_tex_name(layer_idx: int, tex_sub: int) -> str:
     return f"conv2d_{layer_idx}{suffixes[tex_sub]}"
 
 
-def mat4_to_weights(values: list[float], weight: np.ndarray,
-                    out_start: int, in_start: int, ky: int, kx: int,
-                    n_in: int = 4) -> None:
-    """Fill a 4x4 (or 4xN) block of a weight tensor from mat4/MF4x4/MF3x4 values.
+def weight_to_blocks(weight: np.ndarray, n_in: int = 4) -> np.ndarray:
+    """Reshape a conv weight [out, in, ky, kx] into its shader block layout.
 
-    Layout: values[in_col * 4 + out_row] = weight[out_start+out_row, in_start+in_col, ky, kx]
-    (Same mapping for both GLSL column-major mat4 and HLSL row-major MF4x4)
+    Returns [ceil(out/4), ceil(in/n_in), ky, kx, n_in, 4] with
+    blocks[o, i, y, x, col, row] = weight[o*4 + row, i*n_in + col, y, x],
+    i.e. each [..., n_in, 4] block is one mat4/MF4x4 (or MF3x4 for n_in=3)
+    in constructor order. Channels past the tensor edge are zero ("0.0" for
+    `format_floats` string arrays).
     """
-    for col in range(n_in):
-        for row in range(4):
-            in_ch = in_start + col
-            out_ch = out_start + row
-            if in_ch < weight.shape[1] and out_ch < weight.shape[0]:
-                weight[out_ch, in_ch, ky, kx] = values[col * 4 + row]
-
-
-def weight_to_mat4_str(weight: np.ndarray, out_start: int, in_start: int,
-                       ky: int = 0, kx: int = 0) -> str:
-    """Extract 4x4 block from weight tensor -> GLSL/COMP mat4 string."""
-    values = []
-    for j in range(4):
-        for i in range(4):
-            out_ch, in_ch = out_start + i, in_start + j
-            if out_ch < weight.shape[0] and in_ch < weight.shape[1]:
-                values.append(format_float(weight[out_ch, in_ch, ky, kx]))
-            else:
-                values.append("0.0")
-    return f"mat4({', '.join(values)})"
-
-
-def weight_to_mf4x4_str(weight: np.ndarray, out_start: int, in_start: int,
-                        ky: int = 0, kx: int = 0) -> str:
-    """Extract 4x4 block from weight tensor -> HLSL MF4x4 string."""
-    values = []
-    for j in range(4):
-        for i in range(4):
-            out_ch, in_ch = out_start + i, in_start + j
-            if out_ch < weight.shape[0] and in_ch < weight.shape[1]:
-                values.append(format_float(weight[out_ch, in_ch, ky, kx]))
-            else:
-                values.append("0.0")
-    return f"MF4x4({', '.join(values)})"
-
-
-def weight_to_mf3x4_str(weight: np.ndarray, out_start: int, in_start: int,
-                        ky: int = 0, kx: int = 0) -> str:
-    """Extract 3x4 block from weight tensor -> HLSL MF3x4 string (3 input channels)."""
-    values = []
-    for j in range(3):
-        for i in range(4):
-            out_ch, in_ch = out_start + i, in_start + j
-            if out_ch < weight.shape[0] and in_ch < weight.shape[1]:
-                values.append(format_float(weight[out_ch, in_ch, ky, kx]))
-            else:
-                values.append("0.0")
-    return f"MF3x4({', '.join(values)})"
+    out_ch, in_ch, kh, kw = weight.shape
+    n_out, n_blk = -(-out_ch // 4), -(-in_ch // n_in)
+    fill = "0.0" if weight.dtype == object else 0
+    padded = np.full((n_out * 4, n_blk * n_in, kh, kw), fill, dtype=weight.dtype)
+    padded[:out_ch, :in_ch] = weight
+    return padded.reshape(n_out, 4, n_blk, n_in, kh, kw).transpose(0, 2, 4, 5, 3, 1)
+
+
+def blocks_to_weight(blocks: np.ndarray, shape: tuple) -> np.ndarray:
+    """Inverse of weight_to_blocks: crop the block layout back to a float32 [out, in, ky, kx]."""
+    n_out, n_blk, kh, kw, n_in, _ = blocks.shape
+    weight = blocks.transpose(0, 5, 1, 4, 2, 3).reshape(n_out * 4, n_blk * n_in, kh, kw)
+    return np.ascontiguousarray(weight[:shape[0], :shape[1]], dtype=np.float32)
+
+
+def block_strings(blocks: np.ndarray) -> np.ndarray:
+    """Join each [n_in, 4] string block of weight_to_blocks into "v0, v1, ..." constructor arguments."""
+    flat = blocks.reshape(*blocks.shape[:4], -1)
+    joined = flat[..., 0]
+    for k in range(1, flat.shape[-1]):
+        joined = joined + ", " + flat[..., k]
+    return joined
+
+
+def _bias_str(bias: np.ndarray, out_start: int) -> str:
+    block = bias[out_start:out_start + 4]
+    if block.dtype != object:
+        block = format_floats(block)
+    return ", ".join([*block, *["0.0"] * (4 - len(block))])
 
 
 def bias_to_vec4_str(bias: np.ndarray, out_start: int) -> str:
     """Extract 4 bias values -> GLSL/COMP vec4 string."""
-    values = []
-    for i in range(4):
-        out_ch = out_start + i
-        if out_ch < bias.shape[0]:
-            values.append(format_float(bias[out_ch]))
-        else:
-            values.append("0.0")
-    return f"vec4({', '.join(values)})"
+    return f"vec4({_bias_str(bias, out_start)})"
 
 
 def bias_to_mf4_str(bias: np.ndarray, out_start: int) -> str:
     """Extract 4 bias values -> HLSL MF4 string."""
-    values = []
-    for i in range(4):
-        out_ch = out_start + i
-        if out_ch < bias.shape[0]:
-            values.append(format_float(bias[out_ch]))
-        else:
-            values.append("0.0")
-    return f"MF4({', '.join(values)})"
-
-
-def _parse_float_list(text: str) -> list[float]:
-    """Parse a comma-separated list of float literals."""
-    return [float(x.strip()) for x in text.split(",")]
+    return f"MF4({_bias_str(bias, out_start)})"
 
 
 SPATIAL_OFFSETS_3x3 = [(ox, oy) for ox in range(-1, 2) for oy in range(-1, 2)]
@@ -149,15 +189,15 @@ HLSL_LETTER_OFFSETS = {
 
 __all__ = [
     "format_float",
+    "format_floats",
+    "format_model",
     "variant_label",
     "conv_tex_name",
-    "mat4_to_weights",
-    "weight_to_mat4_str",
-    "weight_to_mf4x4_str",
-    "weight_to_mf3x4_str",
+    "weight_to_blocks",
+    "blocks_to_weight",
+    "block_strings",
     "bias_to_vec4_str",
     "bias_to_mf4_str",
-    "_parse_float_list",
     "SPATIAL_OFFSETS_3x3",
     "HLSL_LETTER_OFFSETS",
 ]
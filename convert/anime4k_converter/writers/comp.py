@@ -3,7 +3,13 @@
 import textwrap
 
 from ..ir import Anime4KCNN
-from ..utils import SPATIAL_OFFSETS_3x3, bias_to_vec4_str, weight_to_mat4_str
+from ..utils import (
+    SPATIAL_OFFSETS_3x3,
+    bias_to_vec4_str,
+    block_strings,
+    format_model,
+    weight_to_blocks,
+)
 
 
 def write_comp(ir: Anime4KCNN, path: str,
@@ -53,6 +59,9 @@ def write_comp(ir: Anime4KCNN, path: str,
 
     """)
 
+    text = format_model(ir)
+    head_mats = block_strings(weight_to_blocks(text.head_weight))
+    tail_mats = block_strings(weight_to_blocks(text.tail_weight))
     body = []
 
     # Pass 0: initial conv
@@ -71,11 +80,11 @@ def write_comp(ir: Anime4KCNN, path: str,
         first = True
         for ox, oy in SPATIAL_OFFSETS_3x3:
             ky, kx = ox + 1, oy + 1
-            mat = weight_to_mat4_str(ir.head_weight, out_s, 0, ky, kx)
+            mat = f"mat4({head_mats[out_s // 4, 0, ky, kx]})"
             op = "=" if first else "+="
             body.append(f"        {rv} {op} {mat} * sampleTex(0, icoord, ivec2({ox}, {oy}));")
             first = False
-        bvec = bias_to_vec4_str(ir.head_bias, out_s)
+        bvec = bias_to_vec4_str(text.head_bias, out_s)
         body.append(f"        {rv} += {bvec};")
         body.append("")
 
@@ -89,8 +98,9 @@ def write_comp(ir: Anime4KCNN, path: str,
     n_inp_tex = num_feat // 4
     for mid_idx in range(ir.block_depth - 1):
         pass_idx = mid_idx + 1
-        w = ir.mid_weights[mid_idx]
-        b = ir.mid_biases[mid_idx]
+        w = text.mid_weights[mid_idx]
+        mats = block_strings(weight_to_blocks(w))
+        b = text.mid_biases[mid_idx]
         in_channels = w.shape[1]
         conv_spec = f"Conv-4x3x3x{in_channels}"
 
@@ -111,7 +121,7 @@ def write_comp(ir: Anime4KCNN, path: str,
                 in_s = si * 4
                 for ox, oy in SPATIAL_OFFSETS_3x3:
                     ky, kx = ox + 1, oy + 1
-                    mat = weight_to_mat4_str(w, out_s, in_s, ky, kx)
+                    mat = f"mat4({mats[out_s // 4, in_s // 4, ky, kx]})"
                     op = "=" if first else "+="
                     body.append(f"        {rv} {op} {mat} "
                                 f"* max(sampleTex({si}, icoord, ivec2({ox}, {oy})), 0.0);")
@@ -123,7 +133,7 @@ def write_comp(ir: Anime4KCNN, path: str,
                     in_s = num_feat + si * 4
                     for ox, oy in SPATIAL_OFFSETS_3x3:
                         ky, kx = ox + 1, oy + 1
-                        mat = weight_to_mat4_str(w, out_s, in_s, ky, kx)
+                        mat = f"mat4({mats[out_s // 4, in_s // 4, ky, kx]})"
                         body.append(f"        {rv} += {mat} "
                                     f"* max(-sampleTex({si}, icoord, ivec2({ox}, {oy})), 0.0);")
 
@@ -170,13 +180,13 @@ def write_comp(ir: Anime4KCNN, path: str,
                 if spatial:
                     for ox, oy in spatial:
                         ky, kx = ox + half, oy + half
-                        mat = weight_to_mat4_str(ir.tail_weight, out_s, in_s, ky, kx)
+                        mat = f"mat4({tail_mats[out_s // 4, in_s // 4, ky, kx]})"
                         op = "=" if first else "+="
                         body.append(f"        {rv} {op} {mat} "
                                     f"* max(sampleTex({li * n_tex + ti}, icoord, ivec2({ox}, {oy})), 0.0);")
                         first = False
                 else:
-                    mat = weight_to_mat4_str(ir.tail_weight, out_s, in_s, 0, 0)
+                    mat = f"mat4({tail_mats[out_s // 4, in_s // 4, 0, 0]})"
                     op = "=" if first else "+="
                     body.append(f"        {rv} {op} {mat} "
                                 f"* max(sampleTexCurrent({li * n_tex + ti}, icoord), 0.0);")
@@ -191,15 +201,15 @@ def write_comp(ir: Anime4KCNN, path: str,
                     if spatial:
                         for ox, oy in spatial:
                             ky, kx = ox + half, oy + half
-                            mat = weight_to_mat4_str(ir.tail_weight, out_s, in_s, ky, kx)
+                            mat = f"mat4({tail_mats[out_s // 4, in_s // 4, ky, kx]})"
                             body.append(f"        {rv} += {mat} "
                                         f"* max(-sampleTex({li * n_tex + ti}, icoord, ivec2({ox}, {oy})), 0.0);")
                     else:
-                        mat = weight_to_mat4_str(ir.tail_weight, out_s, in_s, 0, 0)
+                        mat = f"mat4({tail_mats[out_s // 4, in_s // 4, 0, 0]})"
                         body.append(f"        {rv} += {mat} "
                                     f"* max(-sampleTexCurrent({li * n_tex + ti}, icoord), 0.0);")
 
-        bvec = bias_to_vec4_str(ir.tail_bias, out_s)
+        bvec = bias_to_vec4_str(text.tail_bias, out_s)
         body.append(f"        {rv} += {bvec};")
         body.append("")
 
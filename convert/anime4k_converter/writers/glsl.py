@@ -4,9 +4,11 @@ from ..ir import Anime4KCNN
 from ..utils import (
     SPATIAL_OFFSETS_3x3,
     bias_to_vec4_str,
+    block_strings,
     conv_tex_name,
+    format_model,
     variant_label,
-    weight_to_mat4_str,
+    weight_to_blocks,
 )
 
 
@@ -15,6 +17,9 @@ def write_glsl(ir: Anime4KCNN, path: str) -> None:
     label = variant_label(ir)
     num_feat = ir.num_feat
     n_tex = num_feat // 4
+    text = format_model(ir)
+    head_mats = block_strings(weight_to_blocks(text.head_weight))
+    tail_mats = block_strings(weight_to_blocks(text.tail_weight))
     out = []
 
     # License header
@@ -44,13 +49,13 @@ def write_glsl(ir: Anime4KCNN, path: str) -> None:
         first = True
         for ox, oy in SPATIAL_OFFSETS_3x3:
             ky, kx = ox + 1, oy + 1
-            mat = weight_to_mat4_str(ir.head_weight, out_start, 0, ky, kx)
+            mat = f"mat4({head_mats[out_start // 4, 0, ky, kx]})"
             ox_f, oy_f = f"{float(ox):.1f}", f"{float(oy):.1f}"
             op = "vec4 result =" if first else "result +="
             out.append(f"    {op} {mat} * go_0({ox_f}, {oy_f});")
             first = False
 
-        bvec = bias_to_vec4_str(ir.head_bias, out_start)
+        bvec = bias_to_vec4_str(text.head_bias, out_start)
         out.append(f"    result += {bvec};")
         out.append("    return result;")
         out.append("}")
@@ -59,8 +64,9 @@ def write_glsl(ir: Anime4KCNN, path: str) -> None:
     for mid_idx in range(ir.block_depth - 1):
         layer_idx = mid_idx + 1  # output layer
         prev_layer = mid_idx      # input layer
-        w = ir.mid_weights[mid_idx]
-        b = ir.mid_biases[mid_idx]
+        w = text.mid_weights[mid_idx]
+        mats = block_strings(weight_to_blocks(w))
+        b = text.mid_biases[mid_idx]
         in_channels = w.shape[1]
 
         for t in range(n_tex):
@@ -96,7 +102,7 @@ def write_glsl(ir: Anime4KCNN, path: str) -> None:
                 in_s = si * 4
                 for ox, oy in SPATIAL_OFFSETS_3x3:
                     ky, kx = ox + 1, oy + 1
-                    mat = weight_to_mat4_str(w, out_start, in_s, ky, kx)
+                    mat = f"mat4({mats[out_start // 4, in_s // 4, ky, kx]})"
                     ox_f, oy_f = f"{float(ox):.1f}", f"{float(oy):.1f}"
                     op = "vec4 result =" if first else "result +="
                     out.append(f"    {op} {mat} * go_{si}({ox_f}, {oy_f});")
@@ -107,7 +113,7 @@ def write_glsl(ir: Anime4KCNN, path: str) -> None:
                     in_s = num_feat + si * 4
                     for ox, oy in SPATIAL_OFFSETS_3x3:
                         ky, kx = ox + 1, oy + 1
-                        mat = weight_to_mat4_str(w, out_start, in_s, ky, kx)
+                        mat = f"mat4({mats[out_start // 4, in_s // 4, ky, kx]})"
                         ox_f, oy_f = f"{float(ox):.1f}", f"{float(oy):.1f}"
                         out.append(f"    result += {mat} * go_{n_tex + si}({ox_f}, {oy_f});")
 
@@ -160,7 +166,7 @@ def write_glsl(ir: Anime4KCNN, path: str) -> None:
             for ti in range(n_tex):
                 in_s = li * num_feat * ir.factor + ti * 4
                 if ir.tail_kernel == 1:
-                    mat = weight_to_mat4_str(ir.tail_weight, out_start, in_s, 0, 0)
+                    mat = f"mat4({tail_mats[out_start // 4, in_s // 4, 0, 0]})"
                     op = "vec4 result =" if first else "result +="
                     out.append(f"    {op} {mat} * g_{g_idx};")
                     first = False
@@ -170,11 +176,11 @@ def write_glsl(ir: Anime4KCNN, path: str) -> None:
                 for ti in range(n_tex):
                     in_s = li * num_feat * ir.factor + num_feat + ti * 4
                     if ir.tail_kernel == 1:
-                        mat = weight_to_mat4_str(ir.tail_weight, out_start, in_s, 0, 0)
+                        mat = f"mat4({tail_mats[out_start // 4, in_s // 4, 0, 0]})"
                         out.append(f"    result += {mat} * g_{g_idx};")
                     g_idx += 1
 
-        bvec = bias_to_vec4_str(ir.tail_bias, out_start)
+        bvec = bias_to_vec4_str(text.tail_bias, out_start)
         out.append(f"    result += {bvec};")
         out.append("    return result;")
         out.append("}")
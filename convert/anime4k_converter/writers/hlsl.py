@@ -5,11 +5,11 @@ from ..utils import (
     HLSL_LETTER_OFFSETS,
     SPATIAL_OFFSETS_3x3,
     bias_to_mf4_str,
+    block_strings,
     conv_tex_name,
-    format_float,
+    format_model,
     variant_label,
-    weight_to_mf3x4_str,
-    weight_to_mf4x4_str,
+    weight_to_blocks,
 )
 
 
@@ -18,6 +18,9 @@ def write_hlsl(ir: Anime4KCNN, path: str) -> None:
     label = variant_label(ir)
     num_feat = ir.num_feat
     n_tex = num_feat // 4
+    text = format_model(ir)
+    head_mats = block_strings(weight_to_blocks(text.head_weight, n_in=3))
+    tail_mats = block_strings(weight_to_blocks(text.tail_weight))
     out = []
 
     # Header
@@ -126,13 +129,13 @@ def write_hlsl(ir: Anime4KCNN, path: str) -> None:
     for t in range(n_tex):
         out_start = t * 4
         tidx = t + 1
-        bvals = ", ".join(format_float(ir.head_bias[out_start + k]) for k in range(4))
+        bvals = ", ".join(text.head_bias[out_start:out_start + 4])
         out.append(f"\t\t\tMF4 target{tidx} = {{ {bvals} }};")
 
         for si, (si_expr, sj_expr) in enumerate(src_offsets):
             ox, oy = SPATIAL_OFFSETS_3x3[si]
             ky, kx = ox + 1, oy + 1
-            mstr = weight_to_mf3x4_str(ir.head_weight, out_start, 0, ky, kx)
+            mstr = f"MF3x4({head_mats[out_start // 4, 0, ky, kx]})"
             out.append(f"\t\t\ttarget{tidx} = MulAdd(src[{si_expr}][{sj_expr}], {mstr}, target{tidx});")
         out.append("")
 
@@ -152,8 +155,9 @@ def write_hlsl(ir: Anime4KCNN, path: str) -> None:
         pass_num = mid_idx + 2
         layer_idx = mid_idx + 1
         prev_layer = mid_idx
-        w = ir.mid_weights[mid_idx]
-        b = ir.mid_biases[mid_idx]
+        w = text.mid_weights[mid_idx]
+        mats = block_strings(weight_to_blocks(w))
+        b = text.mid_biases[mid_idx]
         in_channels = w.shape[1]
 
         in_textures = [conv_tex_name(prev_layer, ti) for ti in range(n_tex)]
@@ -214,7 +218,7 @@ def write_hlsl(ir: Anime4KCNN, path: str) -> None:
         # MulAdd for each output texture
         for t in range(n_tex):
             out_start = t * 4
-            bvals = ", ".join(format_float(b[out_start + k]) for k in range(4))
+            bvals = ", ".join(b[out_start:out_start + 4])
 
             if t == 0:
                 out.append(f"\tMF4 target = MF4({bvals});")
@@ -228,7 +232,7 @@ def write_hlsl(ir: Anime4KCNN, path: str) -> None:
                 for letter in letters:
                     ox, oy = HLSL_LETTER_OFFSETS[letter]
                     ky, kx = ox + 1, oy + 1
-                    mstr = weight_to_mf4x4_str(w, out_start, in_s, ky, kx)
+                    mstr = f"MF4x4({mats[out_start // 4, in_s // 4, ky, kx]})"
                     out.append(f"\ttarget = MulAdd({letter}{suffix}, {mstr}, target);")
 
             # Negative samples
@@ -239,7 +243,7 @@ def write_hlsl(ir: Anime4KCNN, path: str) -> None:
                     for letter in letters:
                         ox, oy = HLSL_LETTER_OFFSETS[letter]
                         ky, kx = ox + 1, oy + 1
-                        mstr = weight_to_mf4x4_str(w, out_start, in_s, ky, kx)
+                        mstr = f"MF4x4({mats[out_start // 4, in_s // 4, ky, kx]})"
                         out.append(f"\ttarget = MulAdd(n{letter}{suffix}, {mstr}, target);")
 
             out_tex = out_textures[t]
@@ -300,7 +304,7 @@ def write_hlsl(ir: Anime4KCNN, path: str) -> None:
     for t in range(3):
         out_start = t * 4
         tidx = t + 1
-        bstr = bias_to_mf4_str(ir.tail_bias, out_start)
+        bstr = bias_to_mf4_str(text.tail_bias, out_start)
         out.append(f"\tMF4 target{tidx} = {bstr};")
 
         # Positive samples
@@ -308,7 +312,7 @@ def write_hlsl(ir: Anime4KCNN, path: str) -> None:
             layer_idx = gi // n_tpg
             tex_idx = gi % n_tpg
             in_s = layer_idx * num_feat * ir.factor + tex_idx * 4
-            mstr = weight_to_mf4x4_str(ir.tail_weight, out_start, in_s, 0, 0)
+            mstr = f"MF4x4({tail_mats[out_start // 4, in_s // 4, 0, 0]})"
             out.append(f"\ttarget{tidx} = MulAdd(g{gi}, {mstr}, target{tidx});")
 
         # Negative samples
@@ -317,7 +321,7 @@ def write_hlsl(ir: Anime4KCNN, path: str) -> None:
                 layer_idx = gi // n_tpg
                 tex_idx = gi % n_tpg
                 in_s = layer_idx * num_feat * ir.factor + num_feat + tex_idx * 4
-                mstr = weight_to_mf4x4_str(ir.tail_weight, out_start, in_s, 0, 0)
+                mstr = f"MF4x4({tail_mats[out_start // 4, in_s // 4, 0, 0]})"
                 out.append(f"\ttarget{tidx} = MulAdd(ng{gi}, {mstr}, target{tidx});")
 
         out.append("")
@@ -0,0 +1,152 @@
+"""Benchmark the image kernels in misc.py.
+
+Runs every kernel on synthetic 720p / 1080p / 2160p inputs and reports
+latency, throughput in MPix/s and peak memory, then stores the results as
+JSON. Pass an earlier result file with --compare to see the change per case.
+
+Peak memory is measured with tracemalloc, which sees NumPy allocations but
+not buffers allocated inside OpenCV or chainner, so it is a lower bound.
+
+    python bench_misc.py -o bench.json
+    python bench_misc.py -o bench_new.json --compare bench.json
+    python bench_misc.py --sizes 1080p --kernels resize ringing
+"""
+import argparse
+import json
+import platform
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from misc import Filter, fast_gaussian_blur, adaptive_gaussian_blur, unsharp_mask_node, resize, ringing, calculate_ssim, calculate_ms_ssim
+
+SIZES = {
+    "720p": (1280, 720),
+    "1080p": (1920, 1080),
+    "2160p": (3840, 2160),
+}
+
+
+def synthetic_image(size, channels, seed=0):
+    """Smoothed noise with some hard edges, closer to CG than plain noise.
+
+    Single channel images are 2D, like a grayscale cv2.imread.
+    """
+    w, h = size
+    rng = np.random.default_rng(seed)
+    shape = (h, w) if channels == 1 else (h, w, channels)
+    img = cv2.GaussianBlur(rng.integers(0, 256, shape, dtype=np.uint8), (0, 0), 3)
+    img[h // 4 : h // 2, w // 4 : w // 2] = 255
+    return img
+
+
+def kernel_cases():
+    """Yield (kernel, params, function) where function takes the uint8 and float32 inputs."""
+    for sigma in (2, 8, 16, 40):
+        yield "fast_gaussian_blur", {"sigma": sigma}, lambda u8, f32, s=sigma: fast_gaussian_blur(f32, s)
+    for sigma_x, sigma_y in ((8, 8), (40, 40), (40, 3), (0, 20)):
+        for tolerance in (1e-3, 2e-2):
+            yield "adaptive_gaussian_blur", {"sigma_x": sigma_x, "sigma_y": sigma_y, "tolerance": tolerance}, (
+                lambda u8, f32, x=sigma_x, y=sigma_y, t=tolerance: adaptive_gaussian_blur(f32, x, y, t)
+            )
+    for radius in (1, 3, 12):
+        yield "unsharp_mask_node", {"radius": radius}, lambda u8, f32, r=radius: unsharp_mask_node(f32, r, 0.5, 1)
+    for interpolation in Filter:
+        for factor in (0.5, 2):
+            yield "resize", {"filter": interpolation.name, "factor": factor}, (
+                lambda u8, f32, i=interpolation, f=factor: resize(u8, (int(u8.shape[1] * f), int(u8.shape[0] * f)), i)
+            )
+    for radius in (1, 3):
+        yield "ringing", {"radius": radius}, lambda u8, f32, r=radius: ringing(u8, r, 0.1, 1)
+    yield "calculate_ssim", {}, lambda u8, f32: calculate_ssim(f32, f32)
+    yield "calculate_ms_ssim", {}, lambda u8, f32: calculate_ms_ssim(f32, f32)
+
+
+def run_case(function, u8, f32, repeat, warmup):
+    for _ in range(warmup):
+        function(u8, f32)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(u8, f32)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    function(u8, f32)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return times, peak
+
+
+def case_key(result):
+    params = ",".join(f"{k}={v}" for k, v in result["params"].items())
+    return f'{result["kernel"]}[{params}] {result["size"]} c{result["channels"]}'
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {case_key(r): r for r in json.load(f)["results"]}
+    print(f"\nCompared with {baseline_path} (median latency, negative is faster)")
+    for result in results:
+        old = baseline.get(case_key(result))
+        if old is None:
+            continue
+        change = result["median_ms"] / old["median_ms"] - 1
+        print(f'{case_key(result):60} {old["median_ms"]:10.2f} -> {result["median_ms"]:10.2f} ms {change:+8.1%}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the misc.py image kernels.")
+    parser.add_argument("-o", "--output", default="bench_misc.json", help="JSON result file")
+    parser.add_argument("--compare", help="Earlier result file to compare against")
+    parser.add_argument("--sizes", nargs="+", default=list(SIZES), choices=list(SIZES))
+    parser.add_argument("--channels", nargs="+", type=int, default=[3], help="e.g. 1 3 4")
+    parser.add_argument("--kernels", nargs="+", help="Only run these kernels")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--threads", type=int, help="cv2.setNumThreads, default OpenCV's choice")
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        cv2.setNumThreads(args.threads)
+
+    results = []
+    for size_name in args.sizes:
+        for channels in args.channels:
+            u8 = synthetic_image(SIZES[size_name], channels)
+            f32 = u8.astype(np.float32) / 255
+            megapixels = u8.shape[0] * u8.shape[1] / 1e6
+            for kernel, params, function in kernel_cases():
+                if args.kernels and kernel not in args.kernels:
+                    continue
+                times, peak = run_case(function, u8, f32, args.repeat, args.warmup)
+                median = float(np.median(times))
+                result = {
+                    "kernel": kernel,
+                    "params": params,
+                    "size": size_name,
+                    "channels": channels,
+                    "median_ms": median * 1000,
+                    "min_ms": min(times) * 1000,
+                    "mpix_per_s": megapixels / median,
+                    "peak_mib": peak / (1 << 20),
+                }
+                results.append(result)
+                print(f'{case_key(result):60} {result["median_ms"]:10.2f} ms {result["mpix_per_s"]:9.1f} MPix/s {result["peak_mib"]:8.1f} MiB')
+
+    with open(args.output, "w") as f:
+        json.dump({
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "cv2_threads": cv2.getNumThreads(),
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "repeat": args.repeat,
+            "results": results,
+        }, f, indent=1)
+    print(f"Saved {len(results)} results to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
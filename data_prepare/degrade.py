@@ -0,0 +1,281 @@
+"""Compiled degradation chains for degrade_cut.py.
+
+The `action_lr` list of a degrade entry is parsed once into a `Chain` of small
+picklable action objects. Workers only call them, no per-image parsing or
+string dispatch. A new degradation is a class with `sample(rng)`, which draws
+its random parameters once per run, `__call__(img, state, params)` and a
+`halo` (rows of context it needs on each side, in its input pixels),
+registered in `ACTIONS`.
+
+Actions work on float32 images in range 0 to 1. `Chain` converts the source
+once and quantizes once at the end, so a chain such as resize -> ringing ->
+noise does not round trip through uint8 after every step.
+
+With `strip_rows`, a chain runs on overlapping horizontal strips of the source
+instead of the whole image, so only one strip is ever held in float32. Strips
+give the same result as the whole image, except ringing with a radius of 11 or
+more: its downsampled blur depends on where the strip starts and can differ by
+one level.
+"""
+import math
+from fractions import Fraction
+
+import cv2
+import numpy as np
+
+from misc import resize_float, ringing_float, to_float32, to_uint8, FilterDict
+
+
+def parse_factor(value) -> Fraction:
+    """Parse a resize factor such as 0.5, 1.2, "1/3" or "60/120"."""
+    return Fraction(str(value).replace(" ", ""))
+
+
+class Param:
+    """A fixed value, or a [low, high] range sampled uniformly on every call."""
+
+    def __init__(self, value):
+        if isinstance(value, (list, tuple)):
+            self.low, self.high = float(value[0]), float(value[1])
+        else:
+            self.low = self.high = value
+
+    def sample(self, rng):
+        if self.low == self.high:
+            return self.low
+        return rng.uniform(self.low, self.high)
+
+
+class DegradeState:
+    """Side effects of a chain besides the LR image: target size and sub-pixel shift.
+
+    `rows` is the span of source rows the current image covers, the whole
+    image unless the chain runs in strips, and `strip` is the strip index.
+    """
+
+    def __init__(self, original_size, rows=None, strip=0):
+        self.original_size = original_size
+        self.lr_size = original_size
+        self.shift = None
+        self.rows = rows if rows is not None else (0, original_size[1])
+        self.strip = strip
+
+    def hr_shift_matrix(self, scale):
+        if self.shift is None:
+            return None
+        return np.float32([[1, 0, self.shift[0] * scale], [0, 1, self.shift[1] * scale]])
+
+
+class Resize:
+    """Resize to `factor` times the original LR size (not the current size).
+
+    The factor is kept as a Fraction so strip boundaries that are multiples of
+    its denominator map to whole output rows.
+    """
+
+    def __init__(self, interpolation, factor):
+        self.interpolation = interpolation
+        self.factor = parse_factor(factor)
+        self.halo = 0  # depends on the previous scale, filled in by Chain
+
+    def sample(self, rng):
+        return None
+
+    def __call__(self, img, state, params):
+        state.lr_size = [int(i * self.factor) for i in state.original_size]
+        top, bottom = state.rows
+        rows = int(bottom * self.factor) - int(top * self.factor)
+        return resize_float(img, (state.lr_size[0], rows), interpolation=self.interpolation)
+
+
+class Ringing:
+    """Unsharp-mask ringing, `[radius, amount, threshold]`, each fixed or a range.
+
+    An optional fourth value is the blur tolerance passed to `ringing_float`,
+    which trades accuracy for speed on large radii. From radius 11 the blur is
+    approximated on a downsampled image, so strips may differ by one level.
+    """
+
+    def __init__(self, params):
+        self.tolerance = params[3] if len(params) > 3 else None
+        params = params[:3]
+        self.low = np.array([p[0] if isinstance(p, list) else p for p in params], dtype=np.float64)
+        self.high = np.array([p[1] if isinstance(p, list) else p for p in params], dtype=np.float64)
+        self.halo = math.ceil(4 * self.high[0]) + 2
+
+    def sample(self, rng):
+        # One vectorised draw for all parameters; fixed ones have low == high
+        return rng.uniform(self.low, self.high)
+
+    def __call__(self, img, state, params):
+        return ringing_float(img, *params, self.tolerance)
+
+
+class Shift:
+    """Sub-pixel translation `[dx, dy]`; the HR is shifted by the same amount times scale."""
+
+    def __init__(self, params):
+        self.shift = (params[0], params[1])
+        self.matrix = np.float32([[1, 0, params[0]], [0, 1, params[1]]])
+        self.halo = math.ceil(abs(params[1])) + 1
+
+    def sample(self, rng):
+        return None
+
+    def __call__(self, img, state, params):
+        state.shift = self.shift
+        return cv2.warpAffine(img, self.matrix, (img.shape[1], img.shape[0]), flags=cv2.INTER_LINEAR)
+
+
+class Jpeg:
+    """JPEG compression round trip, `quality` fixed or `[low, high]`.
+
+    The encoder needs uint8, so this is the only action that quantizes mid-chain.
+    In strips, Chain aligns strip edges to the 16 pixel JPEG block grid. The
+    halo of one 16 pixel MCU keeps the kept rows clear of the edge blocks, whose
+    chroma upsampling reads across the strip edge.
+    """
+
+    halo = 16
+
+    def __init__(self, quality):
+        self.quality = Param(quality)
+
+    def sample(self, rng):
+        return int(round(self.quality.sample(rng)))
+
+    def __call__(self, img, state, quality):
+        encoded = cv2.imencode(".jpg", to_uint8(img), [cv2.IMWRITE_JPEG_QUALITY, quality])[1]
+        return to_float32(cv2.imdecode(encoded, cv2.IMREAD_UNCHANGED))
+
+
+class Noise:
+    """Additive gaussian noise, `sigma` in 0-255 units, fixed or `[low, high]`."""
+
+    halo = 0
+
+    def __init__(self, sigma):
+        self.sigma = Param(sigma)
+
+    def sample(self, rng):
+        return self.sigma.sample(rng), int(rng.integers(1 << 63))
+
+    def __call__(self, img, state, params):
+        sigma, seed = params
+        # Seeded per strip so strips get independent noise, not one repeated pattern
+        rng = np.random.default_rng((seed, state.strip))
+        noise = rng.normal(0, sigma / 255, img.shape).astype(np.float32)
+        noise += img
+        return np.clip(noise, 0, 1, out=noise)
+
+
+class Blur:
+    """Gaussian blur, `sigma` fixed or `[low, high]`."""
+
+    def __init__(self, sigma):
+        self.sigma = Param(sigma)
+        self.halo = math.ceil(4 * float(self.sigma.high))
+
+    def sample(self, rng):
+        return self.sigma.sample(rng)
+
+    def __call__(self, img, state, sigma):
+        return cv2.GaussianBlur(img, (0, 0), sigmaX=sigma, borderType=cv2.BORDER_REFLECT)
+
+
+ACTIONS = {
+    "ringing": Ringing,
+    "shift": Shift,
+    "jpeg": Jpeg,
+    "noise": Noise,
+    "blur": Blur,
+}
+
+
+class Chain:
+    """A compiled `action_lr` list.
+
+    `img` may be uint8 or an already converted float32 image (see `to_float32`),
+    which lets callers convert a source once and run several chains on it. The
+    result is always uint8.
+    """
+
+    def __init__(self, actions):
+        self.actions = actions
+        # Halo and strip alignment in source rows. A strip edge must land on a
+        # whole row after every resize, and on the JPEG block grid.
+        self.halo = 0
+        self.align = 1
+        self.scale = Fraction(1)
+        for action in actions:
+            if isinstance(action, Resize):
+                # Lanczos-sized support, widened by the ratio when downscaling
+                action.halo = math.ceil(4 * max(1, self.scale / action.factor))
+            elif isinstance(action, Jpeg):
+                # A wrong row spoils its whole block, round the damage up to the grid
+                grid = (16 / self.scale).numerator
+                self.halo = -(-self.halo // grid) * grid
+            self.halo += math.ceil(action.halo / self.scale)
+            if isinstance(action, Resize):
+                self.scale = action.factor
+                self.align = math.lcm(self.align, self.scale.denominator)
+            elif isinstance(action, Jpeg):
+                self.align = math.lcm(self.align, (16 / self.scale).numerator)
+        self.halo = -(-self.halo // self.align) * self.align
+
+    def strip_step(self, h, strip_rows) -> int:
+        """Source rows per strip for an image `h` rows high, or 0 to run it whole.
+
+        Strips need every resize to map `h` to a whole number of rows. A
+        truncated height changes the full-image resize ratio, which strips
+        resized at the exact factor would not match.
+        """
+        step = max(strip_rows // self.align, 1) * self.align
+        if not strip_rows or h <= step + 2 * self.halo:
+            return 0
+        if any((h * action.factor).denominator != 1 for action in self.actions if isinstance(action, Resize)):
+            return 0
+        return step
+
+    def __call__(self, img, rng, strip_rows=0):
+        h, w = img.shape[:2]
+        state = DegradeState((w, h))
+        if not self.actions:
+            return (img if img.dtype == np.uint8 else to_uint8(img)), state
+        params = [action.sample(rng) for action in self.actions]
+        step = self.strip_step(h, strip_rows)
+        if not step:
+            return to_uint8(self._run(to_float32(img), state, params)), state
+
+        out = None
+        for strip, top in enumerate(range(0, h, step)):
+            bottom = min(top + step, h)
+            lo, hi = max(top - self.halo, 0), min(bottom + self.halo, h)
+            state = DegradeState((w, h), rows=(lo, hi), strip=strip)
+            result = self._run(to_float32(img[lo:hi]), state, params)
+            if out is None:
+                lr_h = int(h * self.scale)
+                out = np.empty((lr_h, *result.shape[1:]), dtype=np.uint8)
+            start = int(lo * self.scale)
+            out_top, out_bottom = int(top * self.scale), int(bottom * self.scale)
+            out[out_top:out_bottom] = to_uint8(result[out_top - start : out_bottom - start])
+        return out, state
+
+    def _run(self, img, state, params):
+        for action, action_params in zip(self.actions, params):
+            img = action(img, state, action_params)
+        return img
+
+
+def compile_chain(action_lr) -> Chain:
+    """Compile an `action_lr` list from the YAML config into a `Chain`."""
+    actions = []
+    for entry in action_lr:
+        name, params = next(iter(entry.items()))
+        if name in FilterDict:
+            actions.append(Resize(FilterDict[name], params))
+        elif name in ACTIONS:
+            actions.append(ACTIONS[name](params))
+        else:
+            raise ValueError(f"Unknown degrade action: {name}")
+    return Chain(actions)
@@ -8,16 +8,20 @@ import os
 from os.path import join
 import numpy as np
 import uuid
-from pathlib import Path
-from PIL import Image
 from hashlib import sha256
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+from multiprocessing import Manager
 import shutil
-from misc import resize, ringing, FilterDict, Filter
-from time import time
+from PIL import Image
+from misc import resize, to_float32, FilterDict, Filter
+from degrade import compile_chain
 
 DRY_RUN = False
 MAX_TILE = 100 # unlimited
+PNG_COMPRESS_LEVEL = 1
+MAX_WORKERS = 17
+STRIP_ROWS = 512
 
 
 def parse_yaml(file_path):
@@ -25,86 +29,125 @@ def parse_yaml(file_path):
         data = yaml.safe_load(file)
     return data
 
-def cut(file, config):
+def box_sums(score, tile_size):
+    """Sum of every tile_size x tile_size window anchored at its top-left pixel.
+
+    Same as cv2.filter2D with a box kernel, anchor (0, 0) and BORDER_CONSTANT,
+    computed from a summed-area table.
+    """
+    h, w = score.shape
+    table = np.zeros((h + 1, w + 1), dtype=np.float64)
+    np.cumsum(score, axis=0, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+    y1 = np.minimum(np.arange(h) + tile_size, h)
+    x1 = np.minimum(np.arange(w) + tile_size, w)
+    return np.ascontiguousarray(table[y1][:, x1] - table[:h][:, x1] - table[y1][:, :w] + table[:h, :w])
+
+def select_tiles(score, tile_size, threshold, chunk=4096):
+    """Yield tile positions in the order the old filter2D loop picked them.
+
+    The first window (row-major) whose mean is above the threshold is taken,
+    clamped into the image and zeroed in `score`. Zeroing only lowers window
+    sums, so the scan resumes where it stopped instead of restarting, and only
+    windows overlapping the zeroed tile are recomputed.
+    """
+    h, w = score.shape
+    limit = threshold * (tile_size**2)
+    windows = box_sums(score, tile_size)
+    flat_windows = windows.reshape(-1)
+    candidates = np.flatnonzero(flat_windows > limit)
+    pos = 0
+    while pos < len(candidates):
+        hits = np.flatnonzero(flat_windows[candidates[pos : pos + chunk]] > limit)
+        if len(hits) == 0:
+            pos += chunk
+            continue
+        pos += hits[0]
+        y, x = divmod(int(candidates[pos]), w)
+
+        if x > w - tile_size:
+            x = w - tile_size
+        if y > h - tile_size:
+            y = h - tile_size
+        score[y : y + tile_size, x : x + tile_size] = 0
+
+        y0, x0 = max(y - tile_size + 1, 0), max(x - tile_size + 1, 0)
+        y1, x1 = min(y + tile_size, h), min(x + tile_size, w)
+        patch = score[y0 : min(y1 + tile_size - 1, h), x0 : min(x1 + tile_size - 1, w)]
+        windows[y0:y1, x0:x1] = box_sums(patch, tile_size)[: y1 - y0, : x1 - x0]
+        yield y, x
+
+def load_pair(lr_folder, hr_folder, file):
+    img_lr = cv2.imdecode(np.fromfile(join(lr_folder, file), dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    img_hr = cv2.imdecode(np.fromfile(join(hr_folder, file), dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    return img_lr, img_hr
+
+def cut_pair(file, configs, seen_tiles):
+    """Decode one LR/HR source pair and run every degrade config that uses it.
+
+    Intermediate results that only depend on the target size (the Laplacian
+    tile score and the resized HR) are shared between configs through `cache`.
+    """
+    img_lr, img_hr = load_pair(configs[0]["lr_folder"], configs[0]["hr_folder"], file)
+    cache = {}
+    rng = np.random.default_rng()
+    return [cut(file, img_lr, img_hr, config, seen_tiles, cache, rng) for config in configs]
+
+def cut(file, source_lr, source_hr, config, seen_tiles, cache, rng):
     threshold = config["threshold"]
     scale = config["scale"]
     tile_size = config["tile_size"]
     action_hr = config["action_hr"]
-    action_lr = config["action_lr"]
+    chain = config["chain"]
     lr_folder = config["lr_folder"]
-    hr_folder = config["hr_folder"]
     output_folder = config["output_folder"]
+    output_format = config["output_format"]
     repeat = config["repeat"]
 
-    img_lr = cv2.imdecode(np.fromfile(join(lr_folder, file), dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    strip_rows = config["strip_rows"]
+
     img_lrs = []
-    img_hr = cv2.imdecode(np.fromfile(join(hr_folder, file), dtype=np.uint8), cv2.IMREAD_UNCHANGED)
-    original_size = img_lr.shape[:2][::-1]
-    lr_size = original_size
-    hr_shift_matrix = None
-    
+    img_hr = source_hr
+    if strip_rows:
+        # Memory-aware mode: degrade from the uint8 source one strip at a time
+        source = source_lr
+    else:
+        # The float32 copy of the source is shared by every config and repeat of this pair
+        if "lr_float" not in cache:
+            cache["lr_float"] = to_float32(source_lr)
+        source = cache["lr_float"]
     for _ in range(repeat):
-        for actions in action_lr:
-            action, property = next(iter(actions.items()))
-            if action in FilterDict:
-                factor = eval(str(property))
-                lr_size = [int(i*factor) for i in original_size]
-                img_lr = resize(img_lr, lr_size, interpolation=FilterDict[action])
-            elif action == "ringing":
-                prop = []
-                for p in property:
-                    if isinstance(p, list):
-                        prop.append(np.random.uniform(p[0],p[1]))
-                    else:
-                        prop.append(p)
-                img_lr = ringing(img_lr, *prop)
-                    
-            elif action == "shift":
-                shift_matrix = np.float32([[1, 0, property[0]], [0, 1, property[1]]])
-                hr_shift_matrix = np.float32([[1, 0, property[0]*scale], [0, 1, property[1]*scale]])
-                img_lr = cv2.warpAffine(img_lr, shift_matrix, (img_lr.shape[1], img_lr.shape[0]), flags=cv2.INTER_LINEAR)
+        img_lr, state = chain(source, rng, strip_rows=strip_rows)
         img_lrs.append(img_lr)
+    lr_size = state.lr_size
+    hr_shift_matrix = state.hr_shift_matrix(scale)
     
-    lr_good_img = resize(img_hr, lr_size, interpolation=Filter.CV2_LANCZOS)
     hr_size = [i * scale for i in lr_size]
     if hr_size != list(img_hr.shape[:2][::-1]):
-        img_hr = resize(img_hr, hr_size, interpolation=FilterDict[action_hr])
+        hr_key = ("hr", tuple(hr_size), action_hr)
+        if hr_key not in cache:
+            if strip_rows:
+                # Keep at most one resized HR alive per worker
+                for key in [key for key in cache if key[0] == "hr"]:
+                    del cache[key]
+            cache[hr_key] = resize(img_hr, hr_size, interpolation=FilterDict[action_hr])
+        img_hr = cache[hr_key]
     if hr_shift_matrix is not None:
         img_hr = cv2.warpAffine(img_hr, hr_shift_matrix, (img_hr.shape[1], img_hr.shape[0]), flags=cv2.INTER_LANCZOS4)
 
-    gray = cv2.cvtColor(lr_good_img, cv2.COLOR_BGR2GRAY)  # Converting BGR to gray
-    laplacian = cv2.Laplacian(gray, cv2.CV_64F)
-    out = np.abs(laplacian)
+    score_key = ("score", tuple(lr_size))
+    if score_key not in cache:
+        lr_good_img = resize(source_hr, lr_size, interpolation=Filter.CV2_LANCZOS)
+        gray = cv2.cvtColor(lr_good_img, cv2.COLOR_BGR2GRAY)  # Converting BGR to gray
+        laplacian = cv2.Laplacian(gray, cv2.CV_64F)
+        cache[score_key] = np.abs(laplacian)
+    # select_tiles zeroes picked tiles in place, so work on a copy
+    out = cache[score_key].copy()
     count = 0
-    while True:
-        convolved = cv2.filter2D(
-            out,
-            -1,
-            np.ones((tile_size, tile_size), dtype=np.float64),
-            anchor=(0, 0),
-            borderType=cv2.BORDER_CONSTANT,
-        )
-        
-        ##### Type 1 - choose best
-        # if (average := np.max(convolved) / (tile_size**2)) < threshold:
-        #     print((f"{lr_folder} {base} {count+1}"))
-        #     break
-        # y, x = np.unravel_index(np.argmax(convolved), convolved.shape)
-
-        ##### Type 2 - choose first
-        indices = np.where(convolved > (threshold * (tile_size**2)))
-        if len(indices[0]) == 0:
-            # print((f"{lr_folder} {base} {count+1}"))
-            break
-        y,x = (indices[0][0], indices[1][0])
-
-        if x > lr_good_img.shape[1] - tile_size:
-            x = lr_good_img.shape[1] - tile_size
-        if y > lr_good_img.shape[0] - tile_size:
-            y = lr_good_img.shape[0] - tile_size
-        
-        out[y : y + tile_size, x : x + tile_size] = 0
-        
+    skipped = 0
+    packed = []
+    png_params = [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESS_LEVEL]
+    for y, x in select_tiles(out, tile_size, threshold):
         if not DRY_RUN:
             cutted_hr = img_hr[
                 y * 2 : y * 2 + tile_size * 2, x * 2 : x * 2 + tile_size * 2
@@ -113,11 +156,25 @@ def cut(file, config):
                 print(cutted_hr.shape, tile_size)
                 print(lr_folder, file)
                 exit()
-            
+            hr_bytes = None
+
             for image_lr in img_lrs:
+                cutted_lr = np.ascontiguousarray(image_lr[y : y + tile_size, x : x + tile_size])
                 out_name = uuid.uuid4().hex
-                cv2.imwrite(join(output_folder, "lr", f"{out_name}.png"), image_lr[y : y + tile_size, x : x + tile_size])
-                cv2.imwrite(join(output_folder, "hr", f"{out_name}.png"), cutted_hr)
+                # Hash the raw tile before encoding; setdefault on the shared dict is atomic,
+                # so only the first worker to report a digest writes the pair
+                if seen_tiles.setdefault(sha256(cutted_lr).digest(), out_name) != out_name:
+                    skipped += 1
+                    continue
+                if output_format == "lmdb":
+                    # Encoded here in the worker, written by the single LMDB writer in the parent
+                    if hr_bytes is None:
+                        hr_bytes = cv2.imencode(".png", cutted_hr, png_params)[1].tobytes()
+                    lr_bytes = cv2.imencode(".png", cutted_lr, png_params)[1].tobytes()
+                    packed.append((out_name, lr_bytes, cutted_lr.shape, hr_bytes, cutted_hr.shape))
+                else:
+                    cv2.imwrite(join(output_folder, "lr", f"{out_name}.png"), cutted_lr)
+                    cv2.imwrite(join(output_folder, "hr", f"{out_name}.png"), cutted_hr)
                 count += 1
 
         if count >= MAX_TILE*repeat:
@@ -129,12 +186,78 @@ def cut(file, config):
     # if count == 0:
     #     print((f"\t{file}: {np.max(convolved) / (tile_size**2)}"))
         
-    return count
+    return count, skipped, packed
+
+def estimate_memory(lr_path, hr_path, configs):
+    """Rough peak bytes one worker needs for a cut_pair task.
+
+    Image sizes come from the file headers, nothing is decoded. Counts the
+    uint8 sources, the float32 chain intermediates (a strip of them in strip
+    mode), the repeated LR outputs, the resized HR and the float64 tile score
+    with its summed-area table.
+    """
+    with Image.open(lr_path) as img:
+        lr_w, lr_h = img.size
+        lr_c = len(img.getbands())
+    with Image.open(hr_path) as img:
+        hr_w, hr_h = img.size
+        hr_c = len(img.getbands())
+    lr_px, hr_px = lr_w * lr_h * lr_c, hr_w * hr_h * hr_c
+    peak = 0
+    for config in configs:
+        chain = config["chain"]
+        grow = max(chain.scale, 1) ** 2
+        rows = lr_h
+        step = chain.strip_step(lr_h, config["strip_rows"])
+        if step:
+            rows = min(lr_h, step + 2 * chain.halo)
+        work = 3 * 4 * lr_w * rows * lr_c * grow
+        outputs = config["repeat"] * lr_px * chain.scale**2
+        hr = 5 * hr_px * max(chain.scale, 1) ** 2
+        score = 3 * 8 * lr_w * lr_h * chain.scale**2
+        peak = max(peak, int(work + outputs + hr + score))
+    return lr_px + hr_px + peak
+
+class LmdbWriter:
+    """Write tile pairs to hr.lmdb and lr.lmdb in the BasicSR layout.
+
+    Each database holds PNG bytes keyed by tile name plus a meta_info.txt, which
+    is what neosr's `io_backend: type: lmdb` reads, so training does not have
+    to open hundreds of thousands of small files.
+    """
+
+    def __init__(self, output_folder, map_size=1 << 30):
+        import lmdb
+
+        self.map_full_error = lmdb.MapFullError
+        self.envs = {}
+        self.meta = {}
+        for sub in ("lr", "hr"):
+            path = join(output_folder, f"{sub}.lmdb")
+            self.envs[sub] = lmdb.open(path, map_size=map_size)
+            self.meta[sub] = open(join(path, "meta_info.txt"), "w")
+
+    def write(self, packed):
+        if not packed:
+            return
+        for sub, data_idx in (("lr", 1), ("hr", 3)):
+            env = self.envs[sub]
+            while True:
+                try:
+                    with env.begin(write=True) as txn:
+                        for tile in packed:
+                            txn.put(tile[0].encode("ascii"), tile[data_idx])
+                    break
+                except self.map_full_error:
+                    env.set_mapsize(env.info()["map_size"] * 2)
+            for tile in packed:
+                h, w, c = (*tile[data_idx + 1], 1)[:3]
+                self.meta[sub].write(f"{tile[0]}.png ({h},{w},{c}) {PNG_COMPRESS_LEVEL}\n")
 
-def hash_image(lr_img_path):
-    with Image.open(lr_img_path) as hr_img:
-        image_hash = sha256(hr_img.tobytes()).digest()
-    return lr_img_path, image_hash
+    def close(self):
+        for sub in self.envs:
+            self.meta[sub].close()
+            self.envs[sub].close()
 
 if __name__ == "__main__":
     if len(sys.argv) != 2:
@@ -152,61 +275,93 @@ if __name__ == "__main__":
     default_lr = config.get('default_lr', [0])
     default_hr = config.get('default_hr', [1])
     default_action_hr = config.get('default_action_hr', "CV2_LANCZOS")
+    output_format = config.get('output_format', "png")
+    max_workers = config.get('max_workers', MAX_WORKERS)
+    memory_budget = config.get('memory_budget', 0)
+    strip_rows = config.get('strip_rows', STRIP_ROWS) if memory_budget else 0
         
     if os.path.exists(output_folder):
         shutil.rmtree(output_folder)
     os.makedirs(output_folder, exist_ok=True)
-    os.makedirs(f"{output_folder}/hr", exist_ok=True)
-    os.makedirs(f"{output_folder}/lr", exist_ok=True)
+    if output_format == "lmdb":
+        writer = LmdbWriter(output_folder)
+    else:
+        writer = None
+        os.makedirs(f"{output_folder}/hr", exist_ok=True)
+        os.makedirs(f"{output_folder}/lr", exist_ok=True)
     
-    with ProcessPoolExecutor(max_workers=17) as executor:
-        for index, item in enumerate(degrade):
-            lr_folders = [input_folders[i] for i in (item['lr'] if 'lr' in item else default_lr)]
-            hr_folders = [input_folders[i] for i in (item['hr'] if 'hr' in item else default_hr)]
-            thresholds = item['threshold'] if 'threshold' in item else default_threshold
-            if isinstance(thresholds, int):
-                thresholds = [thresholds]*len(lr_folders)
-            for lr_folder, hr_folder, threshold in zip(lr_folders, hr_folders, thresholds):
-                for root, dirs, files in os.walk(lr_folder):
-                    config = {
-                      "threshold": threshold,
-                      "scale": scale,
-                      "tile_size": tile_size,
-                      "action_hr": item["action_hr"] if "action_hr" in item else default_action_hr,
-                      "action_lr": item["action_lr"],
-                      "lr_folder": lr_folder,
-                      "hr_folder": hr_folder,
-                      "output_folder": output_folder,
-                      "repeat": item["repeat"] if "repeat" in item else 1}
-                    results = [executor.submit(cut, file, config) for file in files]
-                    results = [future.result() for future in as_completed(results)]
-                    print(item["action_lr"], threshold, sum(results))
-                    
-        executor.shutdown(wait=True)
-    
-    start = time()
-    counter = 0
-    lr_path = Path(f"{output_folder}/lr")
-    hr_path = Path(f"{output_folder}/hr")
-    hashed_files = {}
-    unique_hash = set()
-    
-    with ProcessPoolExecutor() as executor:
-        futures = [executor.submit(hash_image, lr_img_path) for lr_img_path in sorted(lr_path.iterdir()) if lr_img_path.suffix in (".png", ".jpg", ".jpeg", ".webp")]
-        for future in as_completed(futures):
-            lr_img_path, image_hash = future.result()
-            hashed_files[lr_img_path] = image_hash
-        executor.shutdown(wait=True)
-        
-    for lr_img_path, image_hash in hashed_files.items():
-        if image_hash not in unique_hash:
-            unique_hash.add(image_hash)
-        else:
-            hr_img_path = hr_path / lr_img_path.name
-            hr_img_path.unlink()
-            lr_img_path.unlink()
-            counter += 1
-            # print(f"Deleted duplicate image {lr_img_path.name}. Matching file: {prev_file.name}")
-    print(f"Deleted {counter} duplicate images in {time()-start} seconds")
+    # Digests of every LR tile written so far, shared with the workers so duplicates are never written
+    manager = Manager()
+    seen_tiles = manager.dict()
+    skipped = 0
 
+    # Group the work by source pair so each LR/HR pair is decoded once for all degrade entries
+    jobs = {}
+    summary = []
+    for index, item in enumerate(degrade):
+        lr_folders = [input_folders[i] for i in (item['lr'] if 'lr' in item else default_lr)]
+        hr_folders = [input_folders[i] for i in (item['hr'] if 'hr' in item else default_hr)]
+        thresholds = item['threshold'] if 'threshold' in item else default_threshold
+        if isinstance(thresholds, int):
+            thresholds = [thresholds]*len(lr_folders)
+        repeat = item["repeat"] if "repeat" in item else 1
+        if repeat < 1:
+            raise ValueError(f"repeat must be at least 1, got {repeat} for {item['action_lr']}")
+        for lr_folder, hr_folder, threshold in zip(lr_folders, hr_folders, thresholds):
+            config = {
+              "threshold": threshold,
+              "scale": scale,
+              "tile_size": tile_size,
+              "action_hr": item["action_hr"] if "action_hr" in item else default_action_hr,
+              "action_lr": item["action_lr"],
+              "chain": compile_chain(item["action_lr"]),
+              "lr_folder": lr_folder,
+              "hr_folder": hr_folder,
+              "output_folder": output_folder,
+              "output_format": output_format,
+              "strip_rows": strip_rows,
+              "repeat": repeat}
+            summary.append(config)
+            for root, dirs, files in os.walk(lr_folder):
+                for file in files:
+                    jobs.setdefault((lr_folder, hr_folder, file), []).append(config)
 
+    workers = max_workers
+    if memory_budget:
+        # Size the pool for the most expensive source pair, not a fixed worker count
+        peak = max(
+            estimate_memory(join(lr_folder, file), join(hr_folder, file), configs)
+            for (lr_folder, hr_folder, file), configs in jobs.items()
+        )
+        workers = max(1, min(max_workers, int(memory_budget * (1 << 30) // peak)))
+        print(f"Estimated {peak / (1 << 20):.0f} MiB per worker, using {workers} workers")
+
+    totals = {id(config): 0 for config in summary}
+    # At most two pairs per worker in flight, and each finished future is
+    # dropped once written, so lmdb tile bytes do not pile up in this process
+    window = 2 * workers
+    tasks = iter(jobs.items())
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        while True:
+            for (_, _, file), configs in islice(tasks, window - len(futures)):
+                futures[executor.submit(cut_pair, file, configs, seen_tiles)] = configs
+            if not futures:
+                break
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                configs = futures.pop(future)
+                for config, (count, skip, packed) in zip(configs, future.result()):
+                    totals[id(config)] += count
+                    skipped += skip
+                    if writer is not None:
+                        writer.write(packed)
+        executor.shutdown(wait=True)
+
+    for config in summary:
+        print(config["action_lr"], config["threshold"], totals[id(config)])
+    
+    manager.shutdown()
+    if writer is not None:
+        writer.close()
+    print(f"Skipped {skipped} duplicate tiles")
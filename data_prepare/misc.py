@@ -7,6 +7,8 @@ import cv2
 import numpy as np
 from enum import IntEnum
 import math
+import functools
+import threading
 
 # About Chainner and cv2 interpolations
 # When upscale: Lanczos4 = lanczos, Cubic = Catmull, and same name is similar
@@ -81,6 +83,75 @@ def random_hsv_color():
 def random_color():
     return (random.randrange(255), random.randrange(255), random.randrange(255))
 
+def _blur_scale_factor(sigma: float) -> float:
+    """Downscale factor of the fast gaussian blur for a given sigma."""
+    if sigma < 11:
+        return 1
+    if sigma < 15:
+        return 1.25
+    if sigma < 20:
+        return 1.5
+    if sigma < 25:
+        return 2
+    if sigma < 30:
+        return 2.5
+    if sigma < 50:
+        return 3
+    if sigma < 100:
+        return 4
+    if sigma < 200:
+        return 6
+    return 8
+
+def _blur_sizing(size: int, sigma: float, f: float) -> tuple[int, float, float]:
+    """
+    Return the size of the downsampled image, the sigma of the downsampled gaussian blur,
+    and the sigma of the upscaled gaussian blur.
+    """
+    if f <= 1:
+        # just use simple gaussian, the error is too large otherwise
+        return size, 0, sigma
+
+    size_down = math.ceil(size / f)
+    f = size / size_down
+    sigma_up = f
+    sigma_down = math.sqrt(sigma**2 - sigma_up**2) / f
+    return size_down, sigma_down, sigma_up
+
+def _downsampled_gaussian_blur(
+    img: np.ndarray,
+    x_sizing: tuple[int, float, float],
+    y_sizing: tuple[int, float, float],
+) -> np.ndarray:
+    h, w, _ = get_h_w_c(img)
+    w_down, x_down_sigma, x_up_sigma = x_sizing
+    h_down, y_down_sigma, y_up_sigma = y_sizing
+
+    if h != h_down or w != w_down:
+        # downsampled gaussian blur
+        img = cv2.resize(img, (w_down, h_down), interpolation=cv2.INTER_AREA)
+        img = cv2.GaussianBlur(
+            img,
+            # an axis that was not downsampled gets no blur here, a 0 sigma would copy the other one
+            (0 if x_down_sigma else 1, 0 if y_down_sigma else 1),
+            sigmaX=x_down_sigma,
+            sigmaY=y_down_sigma,
+            borderType=cv2.BORDER_REFLECT,
+        )
+        img = cv2.resize(img, (w, h), interpolation=cv2.INTER_LINEAR)
+
+    if x_up_sigma != 0 or y_up_sigma != 0:
+        # post blur to smooth out artifacts
+        img = cv2.GaussianBlur(
+            img,
+            (0 if x_up_sigma else 1, 0 if y_up_sigma else 1),
+            sigmaX=x_up_sigma,
+            sigmaY=y_up_sigma,
+            borderType=cv2.BORDER_REFLECT,
+        )
+
+    return img
+
 def fast_gaussian_blur(
     img: np.ndarray,
     sigma_x: float,
@@ -107,98 +178,272 @@ def fast_gaussian_blur(
 
     h, w, _ = get_h_w_c(img)
 
-    def get_scale_factor(sigma: float) -> float:
-        if sigma < 11:
-            return 1
-        if sigma < 15:
-            return 1.25
-        if sigma < 20:
-            return 1.5
-        if sigma < 25:
-            return 2
-        if sigma < 30:
-            return 2.5
-        if sigma < 50:
-            return 3
-        if sigma < 100:
-            return 4
-        if sigma < 200:
-            return 6
-        return 8
-
-    def get_sizing(size: int, sigma: float, f: float) -> tuple[int, float, float]:
-        """
-        Return the size of the downsampled image, the sigma of the downsampled gaussian blur,
-        and the sigma of the upscaled gaussian blur.
-        """
-        if f <= 1:
-            # just use simple gaussian, the error is too large otherwise
-            return size, 0, sigma
-
-        size_down = math.ceil(size / f)
-        f = size / size_down
-        sigma_up = f
-        sigma_down = math.sqrt(sigma**2 - sigma_up**2) / f
-        return size_down, sigma_down, sigma_up
-
     # Handling different sigma values for x and y is difficult, so we take the easy way out
     # and just use the smaller one. There are potentially better ways of combining them, but
-    # this is good enough for now.
-    scale_factor = min(get_scale_factor(sigma_x), get_scale_factor(sigma_y))
-    h_down, y_down_sigma, y_up_sigma = get_sizing(h, sigma_y, scale_factor)
-    w_down, x_down_sigma, x_up_sigma = get_sizing(w, sigma_x, scale_factor)
+    # this is good enough for now. See adaptive_gaussian_blur for per-axis factors.
+    scale_factor = min(_blur_scale_factor(sigma_x), _blur_scale_factor(sigma_y))
+    return _downsampled_gaussian_blur(
+        img,
+        _blur_sizing(w, sigma_x, scale_factor),
+        _blur_sizing(h, sigma_y, scale_factor),
+    )
 
-    if h != h_down or w != w_down:
-        # downsampled gaussian blur
-        img = cv2.resize(img, (w_down, h_down), interpolation=cv2.INTER_AREA)
-        img = cv2.GaussianBlur(
-            img,
-            (0, 0),
-            sigmaX=x_down_sigma,
-            sigmaY=y_down_sigma,
-            borderType=cv2.BORDER_REFLECT,
-        )
-        img = cv2.resize(img, (w, h), interpolation=cv2.INTER_LINEAR)
+# Rough per-pixel cost of the blur building blocks, in units of one kernel tap
+# of a float32 cv2.GaussianBlur pass (measured with bench_misc.py)
+_BLUR_PASS_COST = 12
+_BOX_PASS_COST = 18
+_RESIZE_COST = 8
+# fast_gaussian_blur's documented worst case error
+_DOWNSAMPLE_ERROR = 1e-3
+
+def _gaussian_ksize(sigma: float) -> int:
+    return 2 * math.ceil(4 * sigma) + 1
+
+def _box_widths(sigma: float, passes: int) -> tuple[tuple[int, ...], float] | None:
+    """Odd box widths whose repeated blur has at most sigma**2 variance, and the
+    sigma of the small gaussian that makes up the rest. None if sigma is too small."""
+    ideal = math.sqrt(12 * sigma * sigma / passes + 1)
+    low = int(ideal)
+    low -= low % 2 == 0
+    if low < 3:
+        return None
+    high = low + 2
+
+    def variance(n_low):
+        return (n_low * (low * low - 1) + (passes - n_low) * (high * high - 1)) / 12
+
+    n_low = passes
+    while n_low > 0 and variance(n_low - 1) <= sigma * sigma:
+        n_low -= 1
+    return (low,) * n_low + (high,) * (passes - n_low), math.sqrt(max(sigma * sigma - variance(n_low), 0))
+
+@functools.lru_cache(maxsize=4096)
+def _box_error(sigma: float, passes: int) -> float:
+    """Worst case output error (images in range 0 to 1) of `_box_widths` against a true gaussian."""
+    plan = _box_widths(sigma, passes)
+    if plan is None:
+        return math.inf
+    widths, residual = plan
+    response = np.ones(1)
+    for width in widths:
+        response = np.convolve(response, np.full(width, 1 / width))
+    if residual > 0:
+        response = np.convolve(response, cv2.getGaussianKernel(_gaussian_ksize(residual), residual)[:, 0])
+    x = np.arange(len(response)) - len(response) // 2
+    gaussian = np.exp(-(x**2) / (2 * sigma * sigma))
+    gaussian /= gaussian.sum()
+    return float(np.clip(response - gaussian, 0, None).sum())
+
+def _axis_plan(sigma: float, tolerance: float) -> tuple[float, tuple[int, ...], float]:
+    """Cheapest way to blur one axis within `tolerance`: (cost, box widths, gaussian sigma)."""
+    best = (_BLUR_PASS_COST + _gaussian_ksize(sigma), (), sigma)
+    for passes in range(2, 7):
+        plan = _box_widths(sigma, passes)
+        if plan is None or _box_error(sigma, passes) > tolerance:
+            continue
+        widths, residual = plan
+        cost = passes * _BOX_PASS_COST
+        if residual > 0:
+            cost += _BLUR_PASS_COST + _gaussian_ksize(residual)
+        if cost < best[0]:
+            best = (cost, widths, residual)
+    return best
+
+def adaptive_gaussian_blur(
+    img: np.ndarray,
+    sigma_x: float,
+    sigma_y: float | None = None,
+    tolerance: float = 1e-3,
+) -> np.ndarray:
+    """
+    Channel-wise gaussian blur that picks the fastest method within `tolerance`.
+
+    `tolerance` is the worst case absolute error for images in range 0 to 1.
+    Each axis is planned on its own, so anisotropic sigmas keep their own
+    kernel, and the cheapest of these is used:
+
+    - a direct separable gaussian, cost grows with sigma, exact;
+    - repeated box blurs (cv2.blur is O(1) per pixel regardless of width) plus
+      a small gaussian for the remaining variance, error about 2.6% for 3
+      passes down to 1.2% for 6;
+    - the downsample, blur, upsample path of `fast_gaussian_blur`, with a
+      downscale factor per axis, allowed when `tolerance >= 1e-3`.
+    """
+    if sigma_y is None:
+        sigma_y = sigma_x
+    if sigma_x == 0 and sigma_y == 0:
+        return img.copy()
 
-    if x_up_sigma != 0 or y_up_sigma != 0:
-        # post blur to smooth out artifacts
+    h, w, _ = get_h_w_c(img)
+    plans = [_axis_plan(sigma, tolerance) if sigma > 0 else (0, (), 0) for sigma in (sigma_x, sigma_y)]
+    cost = plans[0][0] + plans[1][0]
+
+    if tolerance >= _DOWNSAMPLE_ERROR:
+        fx, fy = _blur_scale_factor(sigma_x), _blur_scale_factor(sigma_y)
+        x_sizing = _blur_sizing(w, sigma_x, fx)
+        y_sizing = _blur_sizing(h, sigma_y, fy)
+        down_area = (x_sizing[0] * y_sizing[0]) / (w * h)
+        down_cost = 2 * _RESIZE_COST + 2 * _BLUR_PASS_COST
+        down_cost += down_area * (_gaussian_ksize(x_sizing[1]) + _gaussian_ksize(y_sizing[1]))
+        down_cost += _gaussian_ksize(x_sizing[2]) + _gaussian_ksize(y_sizing[2])
+        if down_area < 1 and down_cost < cost:
+            return _downsampled_gaussian_blur(img, x_sizing, y_sizing)
+
+    (_, x_boxes, x_sigma), (_, y_boxes, y_sigma) = plans
+    for width in x_boxes:
+        img = cv2.blur(img, (width, 1), borderType=cv2.BORDER_REFLECT)
+    for width in y_boxes:
+        img = cv2.blur(img, (1, width), borderType=cv2.BORDER_REFLECT)
+    if x_sigma > 0 or y_sigma > 0:
+        ksize = (_gaussian_ksize(x_sigma) if x_sigma > 0 else 1, _gaussian_ksize(y_sigma) if y_sigma > 0 else 1)
         img = cv2.GaussianBlur(
             img,
-            (0, 0),
-            sigmaX=x_up_sigma,
-            sigmaY=y_up_sigma,
+            ksize,
+            sigmaX=x_sigma or 1,
+            sigmaY=y_sigma or 1,
             borderType=cv2.BORDER_REFLECT,
         )
-
+    elif not x_boxes and not y_boxes:
+        img = img.copy()
     return img
 
+MS_SSIM_WEIGHTS = (0.0448, 0.2856, 0.3001, 0.2363, 0.1333)
+
+class SSIM:
+    """SSIM engine with a separable 11x11 Gaussian (sigma 1.5) and reusable buffers.
+
+    The five local moments (mu1, mu2, E[x^2], E[y^2], E[xy]) are stacked
+    vertically in one float32 buffer and filtered in a single `cv2.sepFilter2D`
+    call instead of five 2-D `filter2D` passes; every moment stays a contiguous
+    block for the arithmetic that follows. Buffers are kept between calls of
+    the same shape, so an instance is not thread safe; use one per thread.
+    """
+
+    c1 = 0.01**2
+    c2 = 0.03**2
+    radius = 5
+
+    def __init__(self):
+        self.kernel = cv2.getGaussianKernel(11, 1.5).astype(np.float32)
+        self.buffers = {}
+
+    def _buffer(self, name: str, shape: tuple) -> np.ndarray:
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != shape:
+            buffer = self.buffers[name] = np.empty(shape, dtype=np.float32)
+        return buffer
+
+    def maps(self, img1: np.ndarray, img2: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Return the uncropped SSIM map and contrast-structure map, shape (h, w, c).
+
+        Values within `radius` pixels of the border see neighbouring moments
+        in the stacked buffer and must be cropped by the caller.
+        """
+        h, w, c = get_h_w_c(img1)
+        moments = self._buffer("moments", (5, h, w, c))
+        moments[0] = img1.reshape(h, w, c)
+        moments[1] = img2.reshape(h, w, c)
+        np.multiply(moments[0], moments[0], out=moments[2])
+        np.multiply(moments[1], moments[1], out=moments[3])
+        np.multiply(moments[0], moments[1], out=moments[4])
+        filtered = self._buffer("filtered", moments.shape)
+        cv2.sepFilter2D(
+            moments.reshape(5 * h, w, c), -1, self.kernel, self.kernel, dst=filtered.reshape(5 * h, w, c)
+        )
+        mu1, mu2, e11, e22, e12 = filtered
+
+        mu1_mu2 = mu1 * mu2
+        mu_sq = mu1 * mu1
+        mu_sq += mu2 * mu2
+        # cs = (2 * sigma12 + c2) / (sigma1_sq + sigma2_sq + c2), in place
+        cs_map = e12 - mu1_mu2
+        cs_map *= 2
+        cs_map += self.c2
+        sigma_sq = e11 + e22
+        sigma_sq -= mu_sq
+        sigma_sq += self.c2
+        cs_map /= sigma_sq
+        # luminance term times cs
+        ssim_map = mu1_mu2
+        ssim_map *= 2
+        ssim_map += self.c1
+        mu_sq += self.c1
+        ssim_map /= mu_sq
+        ssim_map *= cs_map
+        return ssim_map, cs_map
+
+    def __call__(self, img1: np.ndarray, img2: np.ndarray) -> float:
+        r = self.radius
+        return float(np.mean(self.maps(img1, img2)[0][r:-r, r:-r]))
+
+    def batch(self, imgs1: np.ndarray, imgs2: np.ndarray) -> np.ndarray:
+        """SSIM of every pair in two (n, h, w[, c]) stacks, as an array of n values.
+
+        The tiles are stacked vertically and filtered as one image. The crop
+        equals the kernel radius, so the pixels that are kept never see a
+        neighbouring tile and the result matches scoring each pair on its own.
+        """
+        n, h = imgs1.shape[:2]
+        stacked1 = np.ascontiguousarray(imgs1).reshape(n * h, *imgs1.shape[2:])
+        stacked2 = np.ascontiguousarray(imgs2).reshape(n * h, *imgs2.shape[2:])
+        ssim_map = self.maps(stacked1, stacked2)[0]
+        r = self.radius
+        return ssim_map.reshape(n, h, *ssim_map.shape[1:])[:, r:-r, r:-r].mean(axis=(1, 2, 3))
+
+    def multi_scale(self, img1: np.ndarray, img2: np.ndarray, weights=MS_SSIM_WEIGHTS) -> float:
+        """MS-SSIM: contrast-structure at every scale, full SSIM at the coarsest.
+
+        Both images go down one shared 2x2-average pyramid (they are stacked as
+        channels so every level is a single resize).
+        """
+        h, w, c = get_h_w_c(img1)
+        min_size = (2 * self.radius + 2) * 2 ** (len(weights) - 1)
+        if min(h, w) < min_size:
+            raise ValueError(f"MS-SSIM with {len(weights)} scales needs images of at least {min_size}px")
+        pair = np.concatenate([img1.reshape(h, w, c), img2.reshape(h, w, c)], axis=2).astype(np.float32, copy=False)
+        r = self.radius
+        result = 1.0
+        for level, weight in enumerate(weights):
+            ssim_map, cs_map = self.maps(pair[..., :c], pair[..., c:])
+            if level == len(weights) - 1:
+                value = float(np.mean(ssim_map[r:-r, r:-r]))
+            else:
+                value = float(np.mean(cs_map[r:-r, r:-r]))
+                h, w = pair.shape[0] // 2, pair.shape[1] // 2
+                pair = cv2.resize(pair[: h * 2, : w * 2], (w, h), interpolation=cv2.INTER_AREA).reshape(h, w, 2 * c)
+            result *= max(value, 0.0) ** weight
+        return result
+
+_ssim_engines = threading.local()
+
+def _ssim_engine() -> SSIM:
+    engine = getattr(_ssim_engines, "engine", None)
+    if engine is None:
+        engine = _ssim_engines.engine = SSIM()
+    return engine
+
 def calculate_ssim(
     img1: np.ndarray,
     img2: np.ndarray,
 ) -> float:
     """Calculates mean localized Structural Similarity Index (SSIM)
     between two images."""
+    return _ssim_engine()(img1, img2)
 
-    c1 = 0.01**2
-    c2 = 0.03**2
-
-    kernel = cv2.getGaussianKernel(11, 1.5)
-    window = np.outer(kernel, kernel.transpose())  # type: ignore
-
-    mu1 = cv2.filter2D(img1, -1, window)[5:-5, 5:-5]
-    mu2 = cv2.filter2D(img2, -1, window)[5:-5, 5:-5]
-    mu1_sq = np.power(mu1, 2)
-    mu2_sq = np.power(mu2, 2)
-    mu1_mu2 = np.multiply(mu1, mu2)
-    sigma1_sq = cv2.filter2D(img1**2, -1, window)[5:-5, 5:-5] - mu1_sq
-    sigma2_sq = cv2.filter2D(img2**2, -1, window)[5:-5, 5:-5] - mu2_sq
-    sigma12 = cv2.filter2D(img1 * img2, -1, window)[5:-5, 5:-5] - mu1_mu2
-
-    ssim_map = ((2 * mu1_mu2 + c1) * (2 * sigma12 + c2)) / (
-        (mu1_sq + mu2_sq + c1) * (sigma1_sq + sigma2_sq + c2)
-    )
+def calculate_ssim_batch(
+    imgs1: np.ndarray,
+    imgs2: np.ndarray,
+) -> np.ndarray:
+    """Calculates SSIM for every pair in two (n, h, w[, c]) float stacks."""
+    return _ssim_engine().batch(imgs1, imgs2)
 
-    return float(np.mean(ssim_map))
+def calculate_ms_ssim(
+    img1: np.ndarray,
+    img2: np.ndarray,
+    weights=MS_SSIM_WEIGHTS,
+) -> float:
+    """Calculates multi-scale SSIM between two float images."""
+    return _ssim_engine().multi_scale(img1, img2, weights)
 
 def get_h_w_c(image: np.ndarray) -> tuple[int, int, int]:
     """Returns the height, width, and number of channels."""
@@ -211,11 +456,15 @@ def unsharp_mask_node(
     radius: float,
     amount: float,
     threshold: float,
+    tolerance: float | None = None,
 ) -> np.ndarray:
     if radius == 0 or amount == 0:
         return img
 
-    blurred = fast_gaussian_blur(img, radius)
+    if tolerance is None:
+        blurred = fast_gaussian_blur(img, radius)
+    else:
+        blurred = adaptive_gaussian_blur(img, radius, tolerance=tolerance)
 
     threshold /= 100
     if threshold == 0:
@@ -227,6 +476,37 @@ def unsharp_mask_node(
 
     return img
 
+def to_float32(image: np.ndarray, out: np.ndarray | None = None) -> np.ndarray:
+    """Convert a 0-255 image to float32 in range 0 to 1, optionally into a preallocated buffer."""
+    if image.dtype == np.float32 and out is None:
+        return image
+    if out is None:
+        out = np.empty(image.shape, dtype=np.float32)
+    np.multiply(image, np.float32(1 / 255), out=out, casting="unsafe")
+    return out
+
+def to_uint8(image: np.ndarray) -> np.ndarray:
+    """Quantize a float image in range 0 to 1 back to uint8, with clipping and rounding."""
+    out = np.multiply(image, 255, dtype=np.float32)
+    np.clip(out, 0, 255, out=out)
+    np.rint(out, out=out)
+    return out.astype(np.uint8)
+
+def resize_float(
+    image: np.ndarray,
+    size: tuple,
+    interpolation: Filter,
+) -> np.ndarray:
+    """Resize a float32 image in range 0 to 1 without leaving the float domain.
+
+    Use this with `ringing_float` to run a chain of operations with a single
+    conversion at each end (`to_float32` / `to_uint8`) instead of one
+    uint8 <-> float32 round trip per step.
+    """
+    if interpolation < Filter.CV2_NEAREST:
+        return resize_chainner(np.ascontiguousarray(image), tuple(size), FILTER_MAP[interpolation], False)
+    return cv2.resize(image, tuple(size), interpolation=FILTER_MAP[interpolation])
+
 def resize(
     image: np.ndarray,
     size: tuple,
@@ -243,20 +523,24 @@ def resize(
         np.ndarray: Resized image, range from 0 to 255.
     """
     if interpolation < Filter.CV2_NEAREST:
-        out = resize_chainner(
-            image.astype(np.float32) / 255.0,
-            tuple(size),
-            FILTER_MAP[interpolation],
-            False,
-        ) * 255
+        out = resize_float(image.astype(np.float32) / 255.0, size, interpolation) * 255
     else:
         out = cv2.resize(image, size, interpolation=FILTER_MAP[interpolation])
     return out.astype(np.uint8)
 
+def ringing_float(image: np.ndarray,
+                  radius: float,
+                  amount: float,
+                  threshold: float,
+                  tolerance: float | None = None) -> np.ndarray:
+    """Same as `ringing`, for a float32 image in range 0 to 1."""
+    return np.clip(unsharp_mask_node(image, radius, amount, threshold, tolerance), 0, 1)
+
 def ringing(image: np.ndarray, 
             radius: float,
             amount: float,
-            threshold: float) -> np.ndarray:
+            threshold: float,
+            tolerance: float | None = None) -> np.ndarray:
     """
     Apply unsharp masking to an image to reduce noise and improve details.
 
@@ -265,11 +549,13 @@ def ringing(image: np.ndarray,
         radius (float): Gaussian kernel radius for unsharp masking.
         amount (float): Strength of unsharp masking. A value of 1 means no change.
         threshold (float): Threshold for suppressing high-frequency details.
+        tolerance (float | None): Blur error allowed for speed, see `adaptive_gaussian_blur`.
+            None keeps `fast_gaussian_blur`.
 
     Returns:
         np.ndarray: Output image, with improved details and reduced noise.
     """
-    img = np.clip(unsharp_mask_node(image.astype(np.float32) / 255, radius, amount, threshold), 0, 1)
+    img = ringing_float(image.astype(np.float32) / 255, radius, amount, threshold, tolerance)
     return (img * 255).astype(np.uint8)
 
 def ssim(
@@ -287,4 +573,36 @@ def ssim(
     Returns:
         float: SSIM value between 0 and 1
     """
-    return calculate_ssim(img1.astype(np.float32) / 255, img2.astype(np.float32) / 255)
\ No newline at end of file
+    return calculate_ssim(img1.astype(np.float32) / 255, img2.astype(np.float32) / 255)
+
+def ssim_batch(
+    imgs1: np.ndarray,
+    imgs2: np.ndarray,
+) -> np.ndarray:
+    """
+    SSIM of every tile pair in two stacks, e.g. LR tiles and downscaled HR tiles.
+
+    Args:
+        imgs1 (np.ndarray): first stack (n, h, w[, c]), range from 0 to 255
+        imgs2 (np.ndarray): second stack, same shape
+
+    Returns:
+        np.ndarray: n SSIM values between 0 and 1
+    """
+    return calculate_ssim_batch(imgs1.astype(np.float32) / 255, imgs2.astype(np.float32) / 255)
+
+def ms_ssim(
+    img1: np.ndarray,
+    img2: np.ndarray,
+) -> float:
+    """
+    Multi-scale SSIM (5 scales) between two images.
+
+    Args:
+        img1 (np.ndarray): first image, range from 0 to 255
+        img2 (np.ndarray): second image, range from 0 to 255
+
+    Returns:
+        float: MS-SSIM value between 0 and 1
+    """
+    return calculate_ms_ssim(img1.astype(np.float32) / 255, img2.astype(np.float32) / 255)
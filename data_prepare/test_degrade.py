@@ -0,0 +1,39 @@
+"""Strip mode of degrade.Chain must match the whole-image result.
+
+Run from this folder with `python -m pytest test_degrade.py`.
+"""
+import cv2
+import numpy as np
+import pytest
+
+from degrade import compile_chain
+
+
+def source(h, w=256, seed=0):
+    img = np.random.default_rng(seed).integers(0, 256, (h, w, 3), dtype=np.uint8)
+    return cv2.GaussianBlur(img, (0, 0), 3)
+
+
+@pytest.mark.parametrize("h", [1080, 2160])
+@pytest.mark.parametrize("action_lr", [
+    [{"jpeg": 50}],
+    [{"CV2_LANCZOS": "1/2"}, {"jpeg": 60}],
+    [{"blur": 2}, {"jpeg": 70}, {"CV2_LANCZOS": "1/2"}, {"jpeg": 80}],
+    [{"ringing": [5, 1.5, 0]}, {"CV2_LINEAR": "40/120"}],
+    [{"shift": [0.5, 0.5]}, {"CV2_CUBIC": "3/4"}],
+    # Chained resizes, strip edges land on whole rows at both factors
+    [{"CV2_LINEAR": "35/120"}, {"CV2_LINEAR": "60/120"}],
+])
+def test_strips_match_whole_image(action_lr, h):
+    chain = compile_chain(action_lr)
+    img = source(h)
+    whole, _ = chain(img, np.random.default_rng(1))
+    strips, _ = chain(img, np.random.default_rng(1), strip_rows=512)
+    assert strips.shape == whole.shape
+    np.testing.assert_array_equal(strips, whole)
+
+
+def test_strip_step_falls_back_on_truncated_resize():
+    chain = compile_chain([{"CV2_LINEAR": "35/120"}, {"CV2_LINEAR": "60/120"}])
+    assert chain.strip_step(1440, 512) > 0
+    assert chain.strip_step(1500, 512) == 0
@@ -0,0 +1,23 @@
+"""Checks for the image kernels in misc.py.
+
+Run from this folder with `python -m pytest test_misc.py`.
+"""
+import cv2
+import numpy as np
+import pytest
+
+from misc import adaptive_gaussian_blur
+
+
+# Sigmas where the box plan of some pass count drops below width 3
+BOUNDARY_SIGMAS = np.round(np.concatenate([np.arange(1.90, 2.11, 0.01), np.arange(2.70, 2.91, 0.01)]), 2)
+
+
+@pytest.mark.parametrize("tolerance", [1e-3, 0.02, 0.05])
+def test_adaptive_gaussian_blur_near_box_boundaries(tolerance):
+    img = np.random.default_rng(0).random((48, 64, 3), dtype=np.float32)
+    for sigma in BOUNDARY_SIGMAS.tolist():
+        out = adaptive_gaussian_blur(img, sigma, sigma, tolerance)
+        exact = cv2.GaussianBlur(img, (0, 0), sigma, borderType=cv2.BORDER_REFLECT)
+        assert out.shape == img.shape
+        assert np.abs(out - exact).max() <= tolerance, sigma
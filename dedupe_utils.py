@@ -0,0 +1,318 @@
+"""Shared helpers for ImageDeDupe.py and ImageDeDupeSingle.py."""
+
+import json
+import os
+import shutil
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from hashlib import sha256
+from pathlib import Path
+import imagehash
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from PIL import Image
+
+
+def sha256_hash(image):
+    return sha256(image.tobytes()).digest()
+
+
+def hash_to_int(image_hash) -> int:
+    """Convert an imagehash.ImageHash to an int so Hamming distance is a popcount."""
+    return int(str(image_hash), 16)
+
+
+HASH_FUNCS = {
+    "phash": imagehash.phash,
+    "average_hash": imagehash.average_hash,
+    "colorhash": imagehash.colorhash,
+    "dhash": imagehash.dhash,
+    "sha256": sha256_hash,
+}
+
+
+def compute_hashes(path, hash_names) -> dict:
+    """Decode an image once and compute every requested hash from the same buffer.
+
+    Perceptual hashes are returned as ints and exact digests as bytes.
+    """
+    hashes = {}
+    with Image.open(path) as img:
+        img.load()
+        for name in hash_names:
+            value = HASH_FUNCS[name](img)
+            hashes[name] = value if isinstance(value, bytes) else hash_to_int(value)
+    return hashes
+
+
+class HashCache:
+    """SQLite cache of image hashes keyed by path, size, mtime_ns and hash type.
+
+    An entry is only reused while the file keeps the size and mtime it had
+    when it was hashed, so edited or replaced images are decoded again.
+    """
+
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            "path TEXT NOT NULL, hash_type TEXT NOT NULL, size INTEGER NOT NULL, "
+            "mtime_ns INTEGER NOT NULL, value TEXT NOT NULL, PRIMARY KEY (path, hash_type))"
+        )
+        self.entries = {
+            (path, hash_type): (size, mtime_ns, value)
+            for path, hash_type, size, mtime_ns, value in self.conn.execute("SELECT * FROM hashes")
+        }
+
+    @staticmethod
+    def _encode(value) -> str:
+        return value.hex() if isinstance(value, bytes) else format(value, "x")
+
+    @staticmethod
+    def _decode(hash_type, value: str):
+        return bytes.fromhex(value) if hash_type == "sha256" else int(value, 16)
+
+    def get(self, path, stat, hash_names) -> dict | None:
+        """Return the cached hashes of `path`, or None if any of them is missing or stale."""
+        key_path = os.path.abspath(path)
+        hashes = {}
+        for name in hash_names:
+            entry = self.entries.get((key_path, name))
+            if entry is None or entry[0] != stat.st_size or entry[1] != stat.st_mtime_ns:
+                return None
+            hashes[name] = self._decode(name, entry[2])
+        return hashes
+
+    def put(self, items) -> None:
+        """Store `(path, stat, hashes)` tuples in a single transaction."""
+        rows = [
+            (os.path.abspath(path), name, stat.st_size, stat.st_mtime_ns, self._encode(value))
+            for path, stat, hashes in items
+            for name, value in hashes.items()
+        ]
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)", rows)
+        for row in rows:
+            self.entries[row[:2]] = row[2:]
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def hash_files(paths, hash_names, jobs: int = 1, chunk_size: int = 64, cache: HashCache | None = None) -> dict:
+    """Hash every path, in a process pool when `jobs > 1`.
+
+    Results keep the order of `paths`, so callers that sort by size still
+    resolve duplicates deterministically in the main process. With a cache,
+    only new or changed files are decoded.
+    """
+    results = {}
+    stats = {}
+    todo = []
+    for path in paths:
+        if cache is not None:
+            stats[path] = path.stat()
+            cached = cache.get(path, stats[path], hash_names)
+            if cached is not None:
+                results[path] = cached
+                continue
+        todo.append(path)
+
+    worker = partial(compute_hashes, hash_names=hash_names)
+    if jobs <= 1:
+        computed = [worker(path) for path in todo]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            computed = list(executor.map(worker, todo, chunksize=chunk_size))
+    results.update(zip(todo, computed))
+
+    if cache is not None and todo:
+        cache.put((path, stats[path], hashes) for path, hashes in zip(todo, computed))
+    return {path: results[path] for path in paths}
+
+
+class MultiIndex:
+    """Multi-index hashing over integer hashes using Hamming distance.
+
+    Hash bits are split into `max_distance + 1` disjoint chunks with one dict
+    per chunk. Two hashes within `max_distance` must agree on at least one
+    whole chunk (pigeonhole), so a lookup only popcounts the hashes sharing a
+    chunk value with the query instead of walking most of the stored set.
+    The last chunk takes every bit above `bits`, so wider hashes stay exact.
+    """
+
+    def __init__(self, max_distance: int, bits: int = 64):
+        n_chunks = max_distance + 1
+        self.max_distance = max_distance
+        self.shifts = [bits * i // n_chunks for i in range(n_chunks)]
+        self.masks = [(1 << (bits * (i + 1) // n_chunks - shift)) - 1 for i, shift in enumerate(self.shifts)]
+        self.masks[-1] = -1
+        self.tables = [{} for _ in range(n_chunks)]
+        self.keys = []
+        self.items = []
+
+    def _chunks(self, key: int):
+        return [(key >> shift) & mask for shift, mask in zip(self.shifts, self.masks)]
+
+    def add(self, key: int, item) -> None:
+        position = len(self.keys)
+        self.keys.append(key)
+        self.items.append(item)
+        for table, chunk in zip(self.tables, self._chunks(key)):
+            table.setdefault(chunk, []).append(position)
+
+    def find(self, key: int, max_distance: int):
+        """Return the item of the first stored hash within `max_distance`, or None."""
+        best = None
+        for table, chunk in zip(self.tables, self._chunks(key)):
+            for position in table.get(chunk, ()):
+                if (best is None or position < best) and (key ^ self.keys[position]).bit_count() <= max_distance:
+                    best = position
+        return None if best is None else self.items[best]
+
+
+class HashIndex:
+    """Index of kept images for one hash type.
+
+    Exact digests and perceptual hashes with `max_distance == 0` are looked up
+    in a dict; larger distances go through multi-index hashing. `bits` is the
+    hash width the chunks are cut from, e.g. 64 for phash and 42 for colorhash;
+    chunks above the real width are always 0 and match every stored hash.
+    """
+
+    def __init__(self, max_distance: int = 0, bits: int = 64):
+        self.max_distance = max_distance
+        self.exact = {}
+        self.near = MultiIndex(max_distance, bits) if max_distance > 0 else None
+
+    def find(self, image_hash):
+        """Return the item stored for a matching hash, or None."""
+        if self.near is None or isinstance(image_hash, bytes):
+            return self.exact.get(image_hash)
+        return self.near.find(image_hash, self.max_distance)
+
+    def add(self, image_hash, item) -> None:
+        if self.near is None or isinstance(image_hash, bytes):
+            self.exact.setdefault(image_hash, item)
+        else:
+            self.near.add(image_hash, item)
+
+
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _popcount(values: np.ndarray) -> np.ndarray:
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    return _POPCOUNT_TABLE[values.view(np.uint8)].reshape(*values.shape, 8).sum(axis=-1)
+
+
+def cluster_hashes(hashes, max_distance: int, block_size: int = 2048) -> np.ndarray:
+    """Group integer hashes whose Hamming distance is at most `max_distance`.
+
+    Identical hashes are collapsed with np.unique first, then the distinct
+    values are compared block against block and the matching pairs form a
+    sparse graph whose connected components are the clusters, so there is no
+    Python loop over pairs. Returns, for every hash, the index of its cluster
+    root, which is always the smallest index in the cluster.
+    """
+    values, inverse = np.unique(np.asarray(hashes, dtype=np.uint64), return_inverse=True)
+    inverse = inverse.ravel()
+    rows, cols = [], []
+    for start in range(0, len(values), block_size):
+        block = values[start:start + block_size]
+        for other in range(start, len(values), block_size):
+            distances = _popcount(block[:, None] ^ values[None, other:other + block_size])
+            r, c = np.nonzero(distances <= max_distance)
+            keep = r + start < c + other
+            rows.append(r[keep] + start)
+            cols.append(c[keep] + other)
+    rows = np.concatenate(rows)
+    graph = coo_matrix((np.ones(len(rows), dtype=np.int8), (rows, np.concatenate(cols))), shape=(len(values), len(values)))
+    n_clusters, labels = connected_components(graph, directed=False)
+    clusters = labels[inverse]
+    roots = np.full(n_clusters, len(inverse), dtype=np.int64)
+    np.minimum.at(roots, clusters, np.arange(len(inverse)))
+    return roots[clusters]
+
+
+def find_duplicates(paths, hashes, max_distance: int = 0, cluster: bool = False) -> list:
+    """Return `(duplicate, kept)` pairs for one hash type.
+
+    `paths` must be sorted largest file first, so the kept file is the
+    largest one: the first match found by the index, or the root of its
+    cluster with `cluster=True`. Clustering is transitive, chains of near
+    matches end up in one group; exact digests always use the index.
+    """
+    if cluster and hashes and not isinstance(hashes[0], bytes):
+        roots = cluster_hashes(hashes, max_distance)
+        return [(paths[i], paths[root]) for i, root in enumerate(roots.tolist()) if root != i]
+
+    bits = 64
+    if hashes and not isinstance(hashes[0], bytes):
+        bits = max(max(image_hash.bit_length() for image_hash in hashes), 1)
+    index = HashIndex(max_distance, bits)
+    duplicates = []
+    for path, image_hash in zip(paths, hashes):
+        match = index.find(image_hash)
+        if match is None:
+            index.add(image_hash, path)
+        else:
+            duplicates.append((path, match))
+    return duplicates
+
+
+def write_plan(plan_path, actions) -> None:
+    """Write planned duplicate removals as JSON.
+
+    Each action is `{"match": kept_file, "files": [[src, dst], ...]}`, where a
+    `dst` of None means the file is deleted instead of moved. The journal of
+    an earlier plan at the same path is removed, so `apply_plan` never skips
+    actions of the new plan as already done.
+    """
+    Path(f"{plan_path}.journal").unlink(missing_ok=True)
+    with open(plan_path, "w", encoding="utf-8") as f:
+        json.dump({"actions": actions}, f, indent=1)
+
+
+def apply_plan(plan_path, batch_size: int = 256) -> int:
+    """Apply a plan written by `write_plan` and return the number of actions applied.
+
+    Finished action indices are appended to `<plan>.journal` and flushed once
+    per batch. Rerunning after a crash skips journaled actions and files that
+    are already gone, so HR/LR pairs end up consistent.
+    """
+    with open(plan_path, encoding="utf-8") as f:
+        actions = json.load(f)["actions"]
+    journal_path = Path(f"{plan_path}.journal")
+    done = set()
+    if journal_path.exists():
+        done = {int(line) for line in journal_path.read_text().split()}
+
+    created_dirs = set()
+    applied = 0
+    with open(journal_path, "a") as journal:
+        for index, action in enumerate(actions):
+            if index in done:
+                continue
+            for src, dst in action["files"]:
+                src = Path(src)
+                if not src.exists():
+                    continue
+                if dst is None:
+                    src.unlink()
+                    continue
+                dst = Path(dst)
+                if dst.parent not in created_dirs:
+                    dst.parent.mkdir(parents=True, exist_ok=True)
+                    created_dirs.add(dst.parent)
+                shutil.move(src, dst)
+            journal.write(f"{index}\n")
+            applied += 1
+            if applied % batch_size == 0:
+                journal.flush()
+                os.fsync(journal.fileno())
+    return applied
@@ -1,43 +1,291 @@
+import argparse
 import shutil
 import os
-import concurrent.futures
+import sqlite3
+from hashlib import sha256
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import torch
 import pyiqa
 from tqdm import tqdm
 import cv2
 
-threshold = 0.7
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".bmp", ".tif", ".tiff"}
 
-input_dir = 'E:\\VNCG\\RIDDLEJOKER'
-output_dir = 'R:\\hyperiqa\\'
 
+def decode_image(filepath, known_digests=None):
+    """Read and decode to a CHW float32 array in range 0 to 1, on a worker thread.
 
-device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
-iqa_metric = pyiqa.create_metric('hyperiqa', device=device)
-
-def process_image(filename):
-    filepath = os.path.join(input_dir, filename)
-    image = cv2.imread(filepath)
+    cv2 and the numpy conversion release the GIL, so several of these run
+    in parallel while the main thread is busy with inference. Returns the
+    sha256 of the file and the image, or None instead of the image when the
+    digest is in `known_digests` (already scored under another path).
+    """
+    data = np.fromfile(filepath, dtype=np.uint8)
+    digest = sha256(data).hexdigest()
+    if known_digests is not None and digest in known_digests:
+        return digest, None
+    image = cv2.imdecode(data, cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f"Cannot decode {filepath}")
     image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    image = torch.from_numpy(image).unsqueeze(0).permute(0,3,1,2)/255
-    score = iqa_metric(image)
-    
-    # if score >= threshold:
-    #     output_filepath = os.path.join(output_dir, filename)
-    #     shutil.copy(filepath, output_filepath)
-    
-    new_filename = f"{int(score*1000)}_{filename}"
-    output_filepath = os.path.join(output_dir, new_filename)
-    shutil.copy(filepath, output_filepath)
-
-# with concurrent.futures.ThreadPoolExecutor(4) as executor:
-#     future_to_filename = {executor.submit(process_image, filename): filename for filename in os.listdir(input_dir)}
-#     for future in tqdm(concurrent.futures.as_completed(future_to_filename), total=len(future_to_filename), desc='Processing Images'):
-#         try:
-#             filename = future_to_filename[future]
-#             result = future.result()
-#         except Exception as e:
-#             print(f'{filename} generated an exception: {e}')
-            
-for filename in tqdm(os.listdir(input_dir)):
-    process_image(filename)
\ No newline at end of file
+    return digest, np.ascontiguousarray(image.transpose(2, 0, 1), dtype=np.float32) / 255
+
+
+def extract_patches(image, patch_size, count=0):
+    """Cut a CHW image into an (n, C, patch_size, patch_size) stack.
+
+    Patches sit on an evenly spaced grid covering the whole image, edge
+    patches flush with the border. With `count`, at most that many are taken,
+    spread evenly over the grid, so the same image always gives the same
+    patches. Images smaller than a patch are returned whole as one patch.
+    """
+    _, h, w = image.shape
+    if h < patch_size or w < patch_size:
+        return image[None]
+    ny, nx = -(-h // patch_size), -(-w // patch_size)
+    ys = np.linspace(0, h - patch_size, ny).round().astype(int)
+    xs = np.linspace(0, w - patch_size, nx).round().astype(int)
+    positions = [(y, x) for y in ys for x in xs]
+    if count and count < len(positions):
+        positions = [positions[i] for i in np.linspace(0, len(positions) - 1, count).round().astype(int)]
+    return np.stack([image[:, y : y + patch_size, x : x + patch_size] for y, x in positions])
+
+
+def aggregate(scores, method):
+    """Combine patch scores with "mean", "min" or a percentile such as "p10"."""
+    if method == "mean":
+        return float(np.mean(scores))
+    if method == "min":
+        return float(np.min(scores))
+    return float(np.percentile(scores, float(method[1:])))
+
+
+class ScoreManifest:
+    """SQLite manifest of scores keyed by path and content hash.
+
+    A path is skipped without reading it while its size and mtime match the
+    manifest; a changed or new path whose sha256 was already scored reuses
+    that score instead of running the model again.
+    """
+
+    def __init__(self, db_path, metric):
+        self.metric = metric
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS scores ("
+            "path TEXT NOT NULL, metric TEXT NOT NULL, sha256 TEXT NOT NULL, size INTEGER NOT NULL, "
+            "mtime_ns INTEGER NOT NULL, score REAL NOT NULL, PRIMARY KEY (path, metric))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS scores_sha256 ON scores (sha256, metric)")
+        rows = self.conn.execute("SELECT path, sha256, size, mtime_ns, score FROM scores WHERE metric = ?", (metric,))
+        self.paths = {}
+        self.digests = {}
+        for path, digest, size, mtime_ns, score in rows:
+            self.paths[path] = (size, mtime_ns, score)
+            self.digests[digest] = score
+
+    def get(self, path, stat):
+        """Return the stored score of `path`, or None if it is new or changed."""
+        entry = self.paths.get(os.path.abspath(path))
+        if entry is None or entry[0] != stat.st_size or entry[1] != stat.st_mtime_ns:
+            return None
+        return entry[2]
+
+    def put(self, items):
+        """Store `(path, stat, sha256, score)` tuples in a single transaction."""
+        rows = [
+            (os.path.abspath(path), self.metric, digest, stat.st_size, stat.st_mtime_ns, score)
+            for path, stat, digest, score in items
+        ]
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?, ?)", rows)
+        for row in rows:
+            self.paths[row[0]] = (row[3], row[4], row[5])
+            self.digests[row[2]] = row[5]
+
+    def close(self):
+        self.conn.close()
+
+
+def prefetch(executor, function, items, window):
+    """Like executor.map, but keeps at most `window` results in flight."""
+    pending = deque()
+    for item in items:
+        pending.append((item, executor.submit(function, item)))
+        if len(pending) >= window:
+            yield pending[0][0], pending.popleft()[1]
+    while pending:
+        yield pending[0][0], pending.popleft()[1]
+
+
+def score_batch(iqa_metric, device, stacks, method="mean"):
+    """Score (n, C, H, W) stacks of one size in one forward pass, one aggregated score per stack."""
+    batch = torch.from_numpy(np.concatenate(stacks)).to(device)
+    with torch.inference_mode():
+        scores = iqa_metric(batch)
+    scores = np.asarray(scores.reshape(-1).float().cpu().tolist())
+    splits = np.cumsum([len(stack) for stack in stacks])[:-1]
+    return [aggregate(part, method) for part in np.split(scores, splits)]
+
+
+def batches_by_size(decoded, batch_size, max_pending):
+    """Group decoded (n, C, H, W) stacks by size and yield (names, stacks) batches.
+
+    Sizes count patches, not images. A group is flushed when it holds
+    `batch_size` patches; when more than `max_pending` patches are waiting
+    across all sizes, the largest group is flushed early so a folder of mixed
+    sizes does not hold everything in memory.
+    """
+    groups = {}
+    counts = {}
+    pending = 0
+    for name, stack in decoded:
+        shape = stack.shape[1:]
+        group = groups.setdefault(shape, ([], []))
+        group[0].append(name)
+        group[1].append(stack)
+        counts[shape] = counts.get(shape, 0) + len(stack)
+        pending += len(stack)
+        if counts[shape] >= batch_size:
+            pending -= counts.pop(shape)
+            yield groups.pop(shape)
+        elif pending > max_pending:
+            shape = max(counts, key=counts.get)
+            pending -= counts.pop(shape)
+            yield groups.pop(shape)
+    yield from groups.values()
+
+
+def copy_scored(input_dir, output_dir, filename, score, threshold, link="copy"):
+    """Place an image in output_dir with a `{score}_` prefix as a copy, hardlink or symlink."""
+    if threshold is not None and score < threshold:
+        return
+    src = os.path.join(input_dir, filename)
+    dst = os.path.join(output_dir, f"{int(score*1000)}_{filename}")
+    if os.path.lexists(dst):
+        return
+    if link == "hard":
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass  # other drive or filesystem without hardlinks
+    elif link == "sym":
+        os.symlink(os.path.abspath(src), dst)
+        return
+    shutil.copy(src, dst)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score images with HyperIQA, copying or linking them with a score prefix or recording scores in a manifest.")
+    parser.add_argument("input_dir", nargs="?", default='E:\\VNCG\\RIDDLEJOKER')
+    parser.add_argument("output_dir", nargs="?", default='R:\\hyperiqa\\')
+    parser.add_argument("--threshold", type=float, default=None, help="Only copy images scoring at least this (e.g. 0.7)")
+    parser.add_argument("--batch-size", type=int, default=8, help="Images (or patches) of the same size scored together")
+    parser.add_argument("--max-pending", type=int, default=64, help="Decoded images (or patches) waiting for a full batch before one is forced")
+    parser.add_argument("--decode-workers", type=int, default=os.cpu_count() or 4, help="Threads decoding images ahead of inference")
+    parser.add_argument("--prefetch", type=int, default=32, help="Images decoded ahead of inference")
+    parser.add_argument("--torch-threads", type=int, default=None, help="torch.set_num_threads, default all cores")
+    parser.add_argument("--cpu", action="store_true", help="Run on CPU even if CUDA is available")
+    parser.add_argument("--manifest", type=str, default=None, help="SQLite file to record scores in; already scored images are skipped. Without --threshold nothing is copied")
+    parser.add_argument("--link", choices=["copy", "hard", "sym"], default="copy", help="How images are placed in output_dir")
+    parser.add_argument("--patch", type=int, default=0, help="Score patch x patch crops instead of the whole image (e.g. 384)")
+    parser.add_argument("--patches", type=int, default=0, help="Crops per image, spread over the grid; 0 tiles the whole image")
+    parser.add_argument("--aggregate", default="mean", help="Combine patch scores with mean, min or a percentile such as p10")
+    parser.add_argument("--pairs", action="store_true", help="input_dir is a degrade_cut output with hr/ and lr/; score the hr tiles and place both")
+    args = parser.parse_args()
+    if args.aggregate not in ("mean", "min") and not (args.aggregate[:1] == "p" and args.aggregate[1:].replace(".", "", 1).isdigit()):
+        parser.error("--aggregate must be mean, min or pNN")
+
+    if args.torch_threads:
+        torch.set_num_threads(args.torch_threads)
+    device = torch.device("cuda") if torch.cuda.is_available() and not args.cpu else torch.device("cpu")
+    iqa_metric = pyiqa.create_metric('hyperiqa', device=device)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # In pair mode the hr tile decides and its lr partner follows it into output_dir
+    subdirs = ["hr", "lr"] if args.pairs else [""]
+    score_dir = os.path.join(args.input_dir, subdirs[0])
+    for sub in subdirs:
+        os.makedirs(os.path.join(args.output_dir, sub), exist_ok=True)
+    filenames = sorted(f for f in os.listdir(score_dir) if os.path.splitext(f)[1].lower() in IMAGE_EXTENSIONS)
+
+    metric = 'hyperiqa'
+    if args.patch:
+        # different patch settings give different scores, keep them apart in the manifest
+        metric = f"hyperiqa_patch{args.patch}x{args.patches}_{args.aggregate}"
+    manifest = ScoreManifest(args.manifest, metric) if args.manifest else None
+    # In manifest mode the score lives in the database, output_dir only gets the threshold subset
+    place = manifest is None or args.threshold is not None
+    stats = {}
+    known = {}
+    todo = filenames
+    if manifest is not None:
+        todo = []
+        for filename in filenames:
+            stats[filename] = os.stat(os.path.join(score_dir, filename))
+            score = manifest.get(os.path.join(score_dir, filename), stats[filename])
+            if score is None:
+                todo.append(filename)
+            else:
+                known[filename] = score
+        print(f"{len(known)} images already scored, {len(todo)} to score")
+
+    # decode threads -> size-grouped batches on the main thread -> copy thread
+    with ThreadPoolExecutor(args.decode_workers) as decoder, ThreadPoolExecutor(2) as writer:
+        writes = []
+        scored = []
+
+        def place_scored(filename, score):
+            for sub in subdirs:
+                writes.append(writer.submit(
+                    copy_scored, os.path.join(args.input_dir, sub), os.path.join(args.output_dir, sub),
+                    filename, score, args.threshold, args.link,
+                ))
+
+        def record(filename, digest, score):
+            if manifest is not None:
+                scored.append((os.path.join(score_dir, filename), stats[filename], digest, score))
+            if place:
+                place_scored(filename, score)
+
+        if place:
+            for filename, score in known.items():
+                place_scored(filename, score)
+
+        def decode(filename):
+            digest, image = decode_image(os.path.join(score_dir, filename), manifest.digests if manifest else None)
+            if image is None:
+                return digest, None
+            # cropping here keeps it off the inference thread
+            return digest, extract_patches(image, args.patch, args.patches) if args.patch else image[None]
+
+        def decoded():
+            for filename, future in prefetch(decoder, decode, todo, args.prefetch):
+                try:
+                    digest, stack = future.result()
+                except Exception as e:
+                    print(f'{filename} generated an exception: {e}')
+                    continue
+                if stack is None:
+                    # same content as an image scored before
+                    record(filename, digest, manifest.digests[digest])
+                    progress.update(1)
+                else:
+                    yield (filename, digest), stack
+
+        with tqdm(total=len(todo), desc='Processing Images') as progress:
+            for names, stacks in batches_by_size(decoded(), args.batch_size, args.max_pending):
+                for (filename, digest), score in zip(names, score_batch(iqa_metric, device, stacks, args.aggregate)):
+                    record(filename, digest, score)
+                progress.update(len(names))
+                if manifest is not None and len(scored) >= 256:
+                    manifest.put(scored)
+                    scored.clear()
+        if manifest is not None:
+            manifest.put(scored)
+            manifest.close()
+        for future in writes:
+            future.result()
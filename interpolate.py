@@ -1,9 +1,19 @@
 # interpolate between 2 shader
+import argparse
+import os
 import re
 import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "convert"))
+
+
 def interpolate(str1, str2, ratio = -0.25):
-    
+    """Blend every number of two shader texts in lockstep (text mode).
+
+    Works on any pair of shaders with the same token layout, but is slow on
+    large files and breaks as soon as the two files differ in structure.
+    """
+
     def replace(match):
         number1 = float(match.group(0))
         number2 = float(next(iter).group(0))
@@ -14,10 +24,54 @@ def interpolate(str1, str2, ratio = -0.25):
     iter = re.finditer(pattern, str2)
     return re.sub(pattern, replace, str1)
 
-if len(sys.argv) < 4:
-    exit()
-str1 = open(sys.argv[1]).read()
-str2 = open(sys.argv[2]).read()
-new = interpolate(str1, str2)
-with open(sys.argv[3], "w") as f:
-    f.write(new)
\ No newline at end of file
+
+def output_paths(output, ratios):
+    """One output path per ratio; several ratios get `_r<ratio>` before the extension."""
+    if len(ratios) == 1:
+        return [output]
+    root, ext = os.path.splitext(output)
+    return [f"{root}_r{ratio:g}{ext}" for ratio in ratios]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Interpolate between two Anime4K shaders: (input1 + input2 * ratio) / (1 + ratio)")
+    parser.add_argument("input1")
+    parser.add_argument("input2")
+    parser.add_argument("output", help="Output shader; its extension picks the writer. Several ratios add _r<ratio> to the name")
+    parser.add_argument("--ratio", type=float, nargs="+", default=[-0.25], help="One or more ratios (default -0.25)")
+    parser.add_argument("--sweep", type=float, nargs=3, metavar=("START", "STOP", "COUNT"), help="Write COUNT models with ratios evenly spaced from START to STOP")
+    parser.add_argument("--text", action="store_true", help="Blend the raw numbers of the two files instead of parsing them (old behaviour)")
+    args = parser.parse_args()
+
+    ratios = list(args.ratio)
+    if args.sweep:
+        from anime4k_converter.interpolate import sweep_ratios
+        ratios = sweep_ratios(args.sweep[0], args.sweep[1], int(args.sweep[2])).tolist()
+    paths = output_paths(args.output, ratios)
+
+    if args.text:
+        str1 = open(args.input1).read()
+        str2 = open(args.input2).read()
+        for ratio, path in zip(ratios, paths):
+            with open(path, "w") as f:
+                f.write(interpolate(str1, str2, ratio))
+        exit()
+
+    from anime4k_converter.cli import FORMAT_PARSERS, FORMAT_WRITERS, detect_format
+    from anime4k_converter.interpolate import interpolate_models
+
+    for path in (args.input1, args.input2):
+        if not detect_format(path):
+            parser.error(f"Unknown format for '{path}', use --text for other shaders")
+    if detect_format(args.output) not in FORMAT_WRITERS:
+        parser.error(f"Cannot write '{args.output}', supported outputs: {', '.join(sorted(FORMAT_WRITERS))}")
+    model1 = FORMAT_PARSERS[detect_format(args.input1)](args.input1)
+    model2 = FORMAT_PARSERS[detect_format(args.input2)](args.input2)
+    writer = FORMAT_WRITERS[detect_format(args.output)]
+    try:
+        models = interpolate_models(model1, model2, ratios)
+    except ValueError as e:
+        parser.error(str(e))
+    for model, path in zip(models, paths):
+        writer(model, path)
+        print(f"Wrote {path}")
@@ -1,19 +1,33 @@
 # clean up manga download from https://dlraw.to/
 import os
+import io
 import argparse
-import shutil
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 from PIL import Image
 
+TARGET_COLOR = 0x34
+ARCHIVE_EXTENSIONS = (".zip", ".cbz")
+
+def border_lut(target_color, bands):
+    """Lookup table for Image.point: 255 where a band differs from the border color by more than 6."""
+    return [255 if abs(p - target_color) > 6 else 0 for p in range(256)] * bands
+
 def trim_image(image, target_color):
-    # Create a mask by comparing pixel colors with the desired color
-    mask = image.point(lambda p: abs(p - target_color) > 6 and 255)
-    
-    w, h = mask.size
-    halfmark = mask.crop((0,0,w,int(h/2)))
-    w1,h1,w2,h2 = halfmark.getbbox()
+    # Create a mask by comparing pixel colors with the desired color.
+    # Only the top half decides the bbox, and a LUT runs in C instead of a per-pixel lambda
+    w, h = image.size
+    halfmark = image.crop((0, 0, w, int(h/2)))
+    mask = halfmark.point(border_lut(target_color, len(halfmark.getbands())))
+    bbox = mask.getbbox()
+    if bbox is None:
+        # nothing but border color, keep the page as is
+        return image
+    w1,h1,w2,h2 = bbox
     trimmed_bbox = (w1,h1,w2,h)
-    
+
     # # Find the bounding box of the non-desired color area
     # trimmed_bbox = mask.getbbox()
 
@@ -21,40 +35,122 @@ def trim_image(image, target_color):
     trimmed_image = image.crop(trimmed_bbox)
     return trimmed_image
 
-def cut_or_copy_images(input_folder, output_folder):
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
-    for filename in tqdm(os.listdir(input_folder)):
-        input_path = os.path.join(input_folder, filename)
-        output_path = os.path.join(output_folder, filename)
+def encode(image, filename, format):
+    buffer = io.BytesIO()
+    image.save(buffer, format=format)
+    return filename, buffer.getvalue()
+
+def cut_page(image, filename, format):
+    """Trim a page and split spreads; returns [(filename, encoded bytes)] in reading order."""
+    trimmed_image = trim_image(image, TARGET_COLOR)
+
+    width, height = trimmed_image.size
+    if width > height:
+        half_width = width // 2
+        left_half = trimmed_image.crop((0, 0, half_width, height))
+        right_half = trimmed_image.crop((half_width, 0, width, height))
+
+        output_left = os.path.splitext(filename)[0] + "_2" + os.path.splitext(filename)[1]
+        output_right = os.path.splitext(filename)[0] + "_1" + os.path.splitext(filename)[1]
+
+        # right to left: the right half is read first
+        return [encode(right_half, output_right, format), encode(left_half, output_left, format)]
+    return [encode(trimmed_image, filename, format)]
 
-        with Image.open(input_path) as image:
-            
-            trimmed_image = trim_image(image, 0x34)
+def cut_file(input_path):
+    with Image.open(input_path) as image:
+        format = image.format or Image.registered_extensions()[os.path.splitext(input_path)[1].lower()]
+        return cut_page(image, os.path.basename(input_path), format)
 
-            width, height = trimmed_image.size
+def cut_bytes(data, filename):
+    with Image.open(io.BytesIO(data)) as image:
+        return cut_page(image, filename, image.format)
 
-            if width > height:
-                half_width = width // 2
-                left_half = trimmed_image.crop((0, 0, half_width, height))
-                right_half = trimmed_image.crop((half_width, 0, width, height))
-                
-                output_left = os.path.splitext(filename)[0] + "_2" + os.path.splitext(filename)[1]
-                output_right = os.path.splitext(filename)[0] + "_1" + os.path.splitext(filename)[1]
+def folder_pages(input_folder):
+    """Yield (worker, args) for every page of a folder, in sorted order."""
+    for filename in sorted(os.listdir(input_folder)):
+        yield cut_file, (os.path.join(input_folder, filename),)
 
-                left_half.save(os.path.join(output_folder, output_left))
-                right_half.save(os.path.join(output_folder, output_right))
-            else:
-                trimmed_image.save(output_path)
+def archive_names(archive):
+    image_extensions = Image.registered_extensions()
+    return sorted(
+        info.filename for info in archive.infolist()
+        if not info.is_dir() and os.path.splitext(info.filename)[1].lower() in image_extensions
+    )
+
+def archive_pages(input_archive):
+    """Yield (worker, args) for every image in a zip/cbz, in sorted order.
+
+    Entries are read one at a time as they are submitted, so only the pages
+    in flight are ever held in memory.
+    """
+    with zipfile.ZipFile(input_archive) as archive:
+        for name in archive_names(archive):
+            yield cut_bytes, (archive.read(name), name)
+
+def in_order(executor, tasks, window):
+    """Submit tasks with at most `window` in flight and yield their results in submission order."""
+    pending = deque()
+    for function, args in tasks:
+        pending.append(executor.submit(function, *args))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def cut_or_copy_images(input_path, output_zip, output_folder=None, jobs=None, window=None):
+    """Cut every page in a process pool and stream the results into `output_zip` in page order.
+
+    `input_path` is a folder of pages or a zip/cbz archive. At most `window`
+    pages (default twice the worker count) are decoded or waiting to be
+    written at any time. Pages are already compressed images, so they are
+    stored without deflate. With `output_folder`, the pages are also written there.
+    """
+    if output_folder is not None:
+        os.makedirs(output_folder, exist_ok=True)
+    if os.path.isfile(input_path):
+        with zipfile.ZipFile(input_path) as archive:
+            total = len(archive_names(archive))
+        tasks = archive_pages(input_path)
+    else:
+        total = len(os.listdir(input_path))
+        tasks = folder_pages(input_path)
+    window = window or 2 * (jobs or os.cpu_count() or 1)
+    with ProcessPoolExecutor(jobs) as executor, zipfile.ZipFile(output_zip, "w", zipfile.ZIP_STORED) as archive:
+        for pages in tqdm(in_order(executor, tasks, window), total=total):
+            for filename, data in pages:
+                archive.writestr(filename, data)
+                if output_folder is not None:
+                    output_path = os.path.join(output_folder, filename)
+                    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                    with open(output_path, "wb") as f:
+                        f.write(data)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("input_folder", help="Path to the input folder")
-    parser.add_argument("output_folder", help="Path to the output folder")
+    parser.add_argument("input_folder", help="Path to the input folder, or a zip/cbz of pages")
+    parser.add_argument("output_folder", help="Path to the output folder, the zip is named after it. An output ending in .zip/.cbz is used as the archive path")
+    parser.add_argument("--keep-folder", action="store_true", help="Also write the pages to the output folder")
+    parser.add_argument("--jobs", type=int, default=None, help="Worker processes, default all cores")
+    parser.add_argument("--window", type=int, default=None, help="Pages in flight at once, default twice --jobs")
     args = parser.parse_args()
 
     output_folder = os.path.abspath(args.output_folder)
     input_folder = os.path.abspath(args.input_folder)
 
-    cut_or_copy_images(input_folder, output_folder)
-    shutil.make_archive(os.path.basename(output_folder), 'zip', output_folder)
\ No newline at end of file
+    if output_folder.lower().endswith(ARCHIVE_EXTENSIONS):
+        output_zip = output_folder
+        output_folder = os.path.splitext(output_folder)[0]
+    elif input_folder.lower().endswith(ARCHIVE_EXTENSIONS):
+        # archive in, archive out
+        output_zip = os.path.basename(output_folder) + ".cbz"
+    else:
+        output_zip = os.path.basename(output_folder) + ".zip"
+
+    cut_or_copy_images(
+        input_folder,
+        output_zip,
+        output_folder if args.keep_folder else None,
+        args.jobs,
+        args.window,
+    )